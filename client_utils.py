@@ -2,13 +2,33 @@ import pickle
 import random, json
 import numpy as np
 import requests, io, zipfile
-import imageio
+from tap_sam.video_io import read_video
+from tap_sam.mask_stream import iter_mask_stream
+from tap_sam.mask_io import read_masks
 from cotracker.utils.visualizer import Visualizer
 
 base_url = 'http://{ip}:{port}'
 
 def request_sam(ip, port, config, mode):
+    """
+    mode "online" tracks and returns the masks, "offline" returns the saved config
+    and masks, "stream" returns the header of the masks and a generator of
+    (frame_idx, (num_objects, 1, H, W) masks) yielding frames while they are tracked.
+    """
     root_url = base_url.format(ip=ip, port=port)
+    if mode == "stream":
+        response = requests.post(
+            f"{root_url}/predict_sam_stream",
+            data=json.dumps(config),
+            headers={"content-type": "application/json"},
+            stream=True,
+        )
+        if response.status_code != 200:
+            # 503 while the models load, the body says why
+            message = response.text
+            response.close()
+            raise requests.HTTPError(f"predict_sam_stream: {response.status_code} {message}", response=response)
+        return iter_mask_stream(lambda size: response.raw.read(size, decode_content=True))
     if mode == "online":
         url = f"{root_url}/predict_sam"
     else:
@@ -18,17 +38,14 @@ def request_sam(ip, port, config, mode):
         url, data=json.dumps(config), headers={"content-type": "application/json"}
     )
     if response.status_code == 200:
+        if mode == "online":
+            return read_masks(response.content)
         zip_io = io.BytesIO(response.content)
         with zipfile.ZipFile(zip_io, "r") as zf:
-            if mode == "online":
-                with zf.open("masks.npy") as f:
-                    masks = np.load(f)
-                return masks
             if mode == "offline":
                 with zf.open("config.json") as f:
                     config = json.load(f)
-                with zf.open("masks.npy") as f:
-                    masks = np.load(f)['masks']
+                masks = read_masks(zf.read("masks.masks"))
                 return config, masks
     else:
         print("Error:", response)
@@ -48,11 +65,7 @@ def request_video(ip, port, video_path):
         with zipfile.ZipFile(zip_io, "r") as zf:
             with zf.open("video.mp4") as f:
                 video = f.read()
-        frames = []
-        reader = imageio.get_reader(video, "mp4")
-        for i, im in enumerate(reader):
-            frames.append(np.array(im))
-        return np.stack(frames)
+        return read_video(video)
     else:
         print("Error:", response)
         return None
@@ -111,14 +124,11 @@ def request_video_and_anno(ip, port, mode, username, button_mode, last_video_pat
                     with zf.open("three_anno_num") as f:
                         three_anno_num = int(f.read().decode("utf-8"))
         
-        frames = []
-        reader = imageio.get_reader(video, "mp4")
-        for _, im in enumerate(reader):
-            frames.append(np.array(im))
+        frames = read_video(video)
         if mode == 'lang':
-            return np.stack(frames), anno, save_path, video_path, int(history_number)
+            return frames, anno, save_path, video_path, int(history_number)
         else:
-            return np.stack(frames), save_path, video_path, int(history_number), \
+            return frames, save_path, video_path, int(history_number), \
                 one_anno_num, all_one_anno_num, two_anno_num, all_two_anno_num, three_anno_num, all_three_anno_num
     else:
         print("Error:", response)
@@ -12,9 +12,8 @@ from PyQt5.QtCore import Qt, QRect, QPoint, pyqtSignal, QThread, QThreadPool, py
 
 import yaml
 from client_utils import request_sam, request_cotracker, request_video, request_video_and_lang
+from tap_sam.overlay import get_colors, render_masks
 import numpy as np
-import torch
-import matplotlib.pyplot as plt
 
 ROOT_DIR = '/mnt/hwfile/OpenRobotLab/wangziqin/data/rh20t/'
 CACHE_NUMBER = 3
@@ -2048,47 +2047,8 @@ class VideoPlayer(QWidget):
 
     def synthesis_image(self, masks_list, video, positive_points_dict):
         obj_id = list(positive_points_dict.keys())
-        cmap = plt.get_cmap("tab10")
-        colors = [np.array([*cmap(int(i))[:3]]) for i in obj_id]
-        mask_image = [torch.tensor(masks_list[i]).permute(2, 3, 1, 0).numpy() * (
-            colors[i].reshape(1, 1, -1)[:, :, :, None]
-        ) for i in range(len(masks_list))]
-        
-        mask_image = [
-            (torch.tensor(mask_image[i]).permute(3, 0, 1, 2) * 255)
-            .numpy()
-            .astype(np.uint8) for i in range(len(mask_image))
-        ]
-        mix_image_list = []
-
-        # add mask to video
-        width, height = mask_image[0][0].shape[1], mask_image[0][0].shape[0]
-        text_scale = width / 800
-        assert video.shape[0] == mask_image[0].shape[0], f"video shape: {video.shape[0]}, mask shape: {mask_image[0].shape[0]}"
-        for i in range(video.shape[0]):      
-            for obj_id in range(len(masks_list)):
-                mix_mask = masks_list[obj_id][i][0][:, :, None].repeat(3, axis=2)
-                mix_image = np.where(mix_mask, mask_image[obj_id][i], video[i]) if obj_id == 0 else np.where(mix_mask, mask_image[obj_id][i], mix_image)
-                # write number on the mask in the image by cv2
-                loc = np.where(mix_mask[:,:,0])
-                if len(loc[0]) == 0:
-                    continue
-                loc = (np.mean(loc[0]).astype(int), np.mean(loc[1]).astype(int))
-                
-                if loc[0] < 10:
-                    loc = (10, loc[1])
-                if loc[1] < 10:
-                    loc = (loc[0], 10)
-                if loc[0] > height - 10:
-                    loc = (height - 10, loc[1])
-                if loc[1] > width - 10:
-                    loc = (loc[0], width - 10)
-                
-                cv2.putText(mix_image, str(obj_id+1), (loc[1], loc[0]), cv2.FONT_HERSHEY_TRIPLEX, text_scale, (255, 255, 255), 1, cv2.LINE_AA)
-            
-            mix_image_list.append(mix_image)
-        
-        return mix_image_list
+        # plain colors on the masks, no blending with the video
+        return render_masks(video, masks_list, get_colors(obj_id), alpha=1.0)
 
     def get_sam_mask_on_image_forward(self, model_config, masks_list, video):
         is_video = model_config["is_video"]
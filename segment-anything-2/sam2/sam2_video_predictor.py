@@ -6,6 +6,7 @@
 
 import warnings
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 
@@ -13,12 +14,183 @@ from tqdm import tqdm
 import numpy as np
 import os
 import pickle
-from PIL import Image
+import shutil
+import tempfile
 
 from sam2.modeling.sam2_base import NO_OBJ_SCORE, SAM2Base
 from sam2.utils.misc import concat_points, fill_holes_in_mask_scores, load_video_frames
 
 
+class ImageFeatureCache:
+    """
+    LRU cache of the backbone features of the frames of one inference state.
+
+    Keeps the `backbone_fpn` of the `capacity` most recently used frames, so
+    a correction click and the re-propagation after it skip the image encoder
+    on frames already seen. `device` is where the entries live: None keeps
+    them on the compute device, "cpu" in pinned CPU memory and "disk" in
+    files under `cache_dir` (a temporary folder by default), copied back to
+    the compute device on every hit.
+    """
+
+    def __init__(self, capacity=64, device=None, cache_dir=None):
+        self.capacity = capacity
+        self.device = device
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        if device == "disk" and cache_dir is None:
+            self.cache_dir = tempfile.mkdtemp(prefix="sam2_features_")
+            self._owns_dir = True
+        else:
+            self._owns_dir = False
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, frame_idx):
+        return frame_idx in self._entries
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "capacity": self.capacity}
+
+    def get(self, frame_idx, device):
+        value = self._entries.get(frame_idx, None)
+        if value is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(frame_idx)
+        self.hits += 1
+        if self.device == "disk":
+            return torch.load(value, map_location=device)
+        return [x.to(device, non_blocking=True) for x in value]
+
+    def put(self, frame_idx, backbone_fpn):
+        if self.capacity <= 0:
+            return
+        if frame_idx in self._entries:
+            self._remove(frame_idx)
+        if self.device == "disk":
+            value = os.path.join(self.cache_dir, f"{id(self)}_{frame_idx}.pt")
+            torch.save([x.cpu() for x in backbone_fpn], value)
+        elif self.device == "cpu":
+            value = [x.to("cpu").pin_memory() if x.is_cuda else x.to("cpu") for x in backbone_fpn]
+        else:
+            value = list(backbone_fpn)
+        self._entries[frame_idx] = value
+        while len(self._entries) > self.capacity:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, frame_idx):
+        value = self._entries.pop(frame_idx)
+        if self.device == "disk" and os.path.exists(value):
+            os.remove(value)
+
+    def clear(self):
+        for frame_idx in list(self._entries):
+            self._remove(frame_idx)
+
+    def __del__(self):
+        if self.device == "disk":
+            self.clear()
+            if self._owns_dir:
+                shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+
+class PrefetchedFeatures:
+    """Backbone output of one frame of a batch encoded ahead of propagation."""
+
+    def __init__(self, batch, index, event=None):
+        # batch: backbone output of the whole batch, or a Future of it (cpu thread)
+        self.batch = batch
+        self.index = index
+        self.event = event
+
+    def result(self):
+        batch = self.batch.result() if hasattr(self.batch, "result") else self.batch
+        out = {
+            "backbone_fpn": [x[self.index:self.index + 1] for x in batch["backbone_fpn"]],
+            "vision_pos_enc": [x[self.index:self.index + 1] for x in batch["vision_pos_enc"]],
+        }
+        if self.event is not None:
+            # the batch was encoded on the prefetch stream; the stream of the
+            # features' device, the current device of the calling thread may differ
+            stream = torch.cuda.current_stream(out["backbone_fpn"][0].device)
+            stream.wait_event(self.event)
+            for x in out["backbone_fpn"] + out["vision_pos_enc"]:
+                x.record_stream(stream)
+        return out
+
+
+class ImageFeaturePrefetcher:
+    """
+    Encodes the frames a propagation will visit in batches of `batch_size`, ahead of it.
+
+    On cuda the batches run on a separate stream, on cpu in a background
+    thread, while the current frame goes through memory attention. Frames
+    whose features are cached, or that hold consolidated outputs, are
+    skipped. The results are picked up by `_get_image_feature` through
+    inference_state["prefetched_features"].
+    """
+
+    def __init__(self, model, inference_state, frame_inds, batch_size):
+        self.model = model
+        self.inference_state = inference_state
+        self.batch_size = batch_size
+        self.device = inference_state["device"]
+        consolidated_frame_inds = inference_state["consolidated_frame_inds"]
+        feature_cache = inference_state.get("feature_cache", None)
+        self.frame_inds = [
+            frame_idx
+            for frame_idx in frame_inds
+            if frame_idx not in consolidated_frame_inds["cond_frame_outputs"]
+            and frame_idx not in consolidated_frame_inds["non_cond_frame_outputs"]
+            and frame_idx not in inference_state["cached_features"]
+            and (feature_cache is None or model._get_feature_cache_key(inference_state, frame_idx) not in feature_cache)
+        ]
+        self.position = 0
+        self.stream, self.executor = None, None
+        if self.device.type == "cuda":
+            self.stream = torch.cuda.Stream(self.device)
+        else:
+            self.executor = ThreadPoolExecutor(1)
+        self.prefetched = inference_state["prefetched_features"] = {}
+
+    def _encode(self, frame_inds):
+        images = torch.cat(
+            [self.inference_state["images"][frame_idx].to(self.device).float().unsqueeze(0) for frame_idx in frame_inds]
+        )
+        return self.model.forward_image(images)
+
+    def _encode_in_thread(self, frame_inds):
+        # inference mode is per thread
+        with torch.inference_mode():
+            return self._encode(frame_inds)
+
+    def step(self):
+        """Submit batches until two batches of not yet used frames are in flight."""
+        while self.position < len(self.frame_inds) and len(self.prefetched) < 2 * self.batch_size:
+            frame_inds = self.frame_inds[self.position:self.position + self.batch_size]
+            self.position += len(frame_inds)
+            event = None
+            if self.stream is not None:
+                self.stream.wait_stream(torch.cuda.current_stream(self.device))
+                with torch.cuda.stream(self.stream):
+                    batch = self._encode(frame_inds)
+                    event = torch.cuda.Event()
+                    event.record(self.stream)
+            else:
+                batch = self.executor.submit(self._encode_in_thread, frame_inds)
+            for index, frame_idx in enumerate(frame_inds):
+                self.prefetched[frame_idx] = PrefetchedFeatures(batch, index, event)
+
+    def close(self):
+        self.prefetched.clear()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+
 class SAM2VideoPredictor(SAM2Base):
     """The predictor class to handle user interactions and manage inference states."""
 
@@ -32,6 +204,12 @@ class SAM2VideoPredictor(SAM2Base):
         clear_non_cond_mem_around_input=False,
         # whether to also clear non-conditioning memory of the surrounding frames (only effective when `clear_non_cond_mem_around_input` is True).
         clear_non_cond_mem_for_multi_obj=False,
+        # frames whose backbone features each inference state keeps, and where (see ImageFeatureCache)
+        image_feature_cache_size=64,
+        image_feature_cache_device=None,
+        image_feature_cache_dir=None,
+        # frames encoded together ahead of propagation, 0 encodes each frame when it is tracked
+        prefetch_batch_size=0,
         **kwargs,
     ):
         super().__init__(**kwargs)
@@ -39,6 +217,15 @@ class SAM2VideoPredictor(SAM2Base):
         self.non_overlap_masks = non_overlap_masks
         self.clear_non_cond_mem_around_input = clear_non_cond_mem_around_input
         self.clear_non_cond_mem_for_multi_obj = clear_non_cond_mem_for_multi_obj
+        self.image_feature_cache_size = image_feature_cache_size
+        self.image_feature_cache_device = image_feature_cache_device
+        self.image_feature_cache_dir = image_feature_cache_dir
+        self.prefetch_batch_size = prefetch_batch_size
+
+    def _new_image_feature_cache(self):
+        return ImageFeatureCache(
+            self.image_feature_cache_size, self.image_feature_cache_device, self.image_feature_cache_dir
+        )
 
     @torch.inference_mode()
     def init_state(
@@ -80,7 +267,7 @@ class SAM2VideoPredictor(SAM2Base):
         inference_state["point_inputs_per_obj"] = {}
         inference_state["mask_inputs_per_obj"] = {}
         # visual features on a small number of recently visited frames for quick interactions
-        inference_state["cached_features"] = {}
+        inference_state["cached_features"] = self._new_image_feature_cache()
         # values that don't change across frames (so we only need to hold one copy of them)
         inference_state["constants"] = {}
         # mapping between client-side object id and model-side object index
@@ -654,8 +841,14 @@ class SAM2VideoPredictor(SAM2Base):
         start_frame_idx=None,
         max_frame_num_to_track=None,
         reverse=False,
+        prefetch_batch_size=None,
     ):
-        """Propagate the input points across frames to track in the entire video."""
+        """
+        Propagate the input points across frames to track in the entire video.
+        With `prefetch_batch_size` (default: the predictor's) > 0 the image
+        encoder runs on batches of upcoming frames ahead of tracking, see
+        ImageFeaturePrefetcher.
+        """
         self.propagate_in_video_preflight(inference_state)
 
         output_dict = inference_state["output_dict"]
@@ -688,7 +881,28 @@ class SAM2VideoPredictor(SAM2Base):
             )
             processing_order = range(start_frame_idx, end_frame_idx + 1)
 
+        if prefetch_batch_size is None:
+            prefetch_batch_size = self.prefetch_batch_size
+        prefetcher = None
+        if prefetch_batch_size > 0:
+            prefetcher = ImageFeaturePrefetcher(self, inference_state, processing_order, prefetch_batch_size)
+        try:
+            yield from self._propagate_frames(
+                inference_state, processing_order, batch_size, clear_non_cond_mem, reverse, prefetcher
+            )
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
+
+    def _propagate_frames(
+        self, inference_state, processing_order, batch_size, clear_non_cond_mem, reverse, prefetcher=None
+    ):
+        output_dict = inference_state["output_dict"]
+        consolidated_frame_inds = inference_state["consolidated_frame_inds"]
+        obj_ids = inference_state["obj_ids"]
         for frame_idx in tqdm(processing_order, desc="propagate in video"):
+            if prefetcher is not None:
+                prefetcher.step()
             # We skip those frames already in consolidated outputs (these are frames
             # that received input clicks or mask). Note that we cannot directly run
             # batched forward on them via `_run_single_frame_inference` because the
@@ -794,22 +1008,43 @@ class SAM2VideoPredictor(SAM2Base):
 
     def _get_image_feature(self, inference_state, frame_idx, batch_size):
         """Compute the image features on a given frame."""
-        # Look up in the cache first
-        # image, backbone_out = inference_state["cached_features"].get(
-        #     frame_idx, (None, None)
-        # )
         device = inference_state["device"]
-        image = inference_state["images"][frame_idx].to(device).float().unsqueeze(0)
-        backbone_out = inference_state["cached_image_features"].get(-1, None)
-        
-        if backbone_out is None:
-            # Cache miss -- we will run inference on a single image
-            device = inference_state["device"]
-            backbone_out = self.forward_image(image)
-            # Cache the most recent frame's feature (for repeated interactions with
-            # a frame; we can use an LRU cache for more frames in the future).
-            inference_state["cached_features"] = dict(frame_idx=(image, backbone_out))
-            inference_state["cached_image_features"][frame_idx] = backbone_out
+        image = None
+        # look up the frames of this state first (see ImageFeatureCache), then the
+        # features shared across requests (see tap_sam/feature_cache.py); the
+        # position encoding only depends on the image size and is kept once
+        backbone_fpn = inference_state["cached_features"].get(frame_idx, device)
+        pos_enc = inference_state["constants"].get("vision_pos_enc", None)
+        feature_cache = inference_state.get("feature_cache", None)
+        if feature_cache is not None:
+            cache_key = self._get_feature_cache_key(inference_state, frame_idx)
+            pos_enc_key = ("vision_pos_enc", self.image_size)
+            if pos_enc is None:
+                pos_enc = feature_cache.get(pos_enc_key, device, count=False)
+            if backbone_fpn is None:
+                cached = feature_cache.get(cache_key, device)
+                if cached is not None:
+                    image, backbone_fpn = cached
+                    inference_state["cached_features"].put(frame_idx, backbone_fpn)
+
+        if image is None:
+            image = inference_state["images"][frame_idx].to(device).float().unsqueeze(0)
+        if backbone_fpn is not None and pos_enc is not None:
+            backbone_out = {"backbone_fpn": list(backbone_fpn), "vision_pos_enc": list(pos_enc)}
+        else:
+            prefetched = inference_state.get("prefetched_features", {}).pop(frame_idx, None)
+            if prefetched is not None:
+                # encoded ahead in a batch by ImageFeaturePrefetcher
+                backbone_out = prefetched.result()
+            else:
+                # Cache miss -- we will run inference on a single image
+                backbone_out = self.forward_image(image)
+            inference_state["cached_features"].put(frame_idx, backbone_out["backbone_fpn"])
+            if feature_cache is not None:
+                feature_cache.put(cache_key, (image, list(backbone_out["backbone_fpn"])))
+                if pos_enc_key not in feature_cache:
+                    feature_cache.put(pos_enc_key, list(backbone_out["vision_pos_enc"]))
+        inference_state["constants"]["vision_pos_enc"] = list(backbone_out["vision_pos_enc"])
 
         # expand the features to have the same dimension as the number of objects
         expanded_image = image.expand(batch_size, -1, -1, -1)
@@ -829,6 +1064,12 @@ class SAM2VideoPredictor(SAM2Base):
         features = (expanded_image,) + features
         return features
 
+    def _get_feature_cache_key(self, inference_state, frame_idx):
+        frame_indices = inference_state.get("frame_indices", None)
+        if frame_indices is not None:
+            frame_idx = frame_indices[frame_idx]
+        return (inference_state["video_path"], int(frame_idx), self.image_size)
+
     def _run_single_frame_inference(
         self,
         inference_state,
@@ -969,6 +1210,33 @@ class SAM2VideoPredictor(SAM2Base):
                 obj_output_dict["non_cond_frame_outputs"].pop(t, None)
 
 
+def prepare_frames(
+    frames,
+    image_size,
+    img_mean=(0.485, 0.456, 0.406),
+    img_std=(0.229, 0.224, 0.225),
+    device=torch.device("cpu"),
+    batch_size=32,
+):
+    """
+    Resize a (T, H, W, 3) uint8 clip to (T, 3, image_size, image_size) and normalize it.
+    The clip goes through torch `interpolate` in batches of `batch_size` frames on
+    `device` (bicubic with antialiasing, like the PIL resize it replaces).
+    """
+    device = torch.device(device)
+    img_mean = torch.tensor(img_mean, dtype=torch.float32, device=device)[:, None, None]
+    img_std = torch.tensor(img_std, dtype=torch.float32, device=device)[:, None, None]
+    images = torch.empty(len(frames), 3, image_size, image_size, dtype=torch.float32, device=device)
+    for start in range(0, len(frames), batch_size):
+        batch = torch.from_numpy(np.ascontiguousarray(frames[start:start + batch_size])).to(device)
+        batch = batch.permute(0, 3, 1, 2).float().div_(255.0)
+        batch = torch.nn.functional.interpolate(
+            batch, size=(image_size, image_size), mode="bicubic", align_corners=False, antialias=True
+        ).clamp_(0.0, 1.0)
+        images[start:start + len(batch)] = (batch - img_mean) / img_std
+    return images
+
+
 class SAM2VideoPredictorFast(SAM2VideoPredictor):
     
     def load_video_frames(
@@ -978,34 +1246,39 @@ class SAM2VideoPredictorFast(SAM2VideoPredictor):
         offload_video_to_cpu,
         img_mean=(0.485, 0.456, 0.406),
         img_std=(0.229, 0.224, 0.225),
-        compute_device=torch.device("cuda"),
+        compute_device=None,
+        feature_cache=None,
+        cache_keys=None,
     ):
+        if compute_device is None:
+            compute_device = self.device
+        video_list = np.asarray(video_list)
         num_frames = len(video_list)
-        img_mean = torch.tensor(img_mean, dtype=torch.float32)[:, None, None]
-        img_std = torch.tensor(img_std, dtype=torch.float32)[:, None, None]
-        images = torch.zeros(num_frames, 3, image_size, image_size, dtype=torch.float32)
-        for n, img in enumerate(tqdm(video_list, desc="frame loading (JPEG)")):
-            images[n], video_height, video_width = self._convert_img_as_tensor(img, image_size)
-        if not offload_video_to_cpu:
-            images = images.to(compute_device)
-            img_mean = img_mean.to(compute_device)
-            img_std = img_std.to(compute_device)
-        # normalize by mean and std
-        images -= img_mean
-        images /= img_std
+        video_height, video_width = video_list.shape[1:3]
+        storage_device = torch.device("cpu") if offload_video_to_cpu else compute_device
+        images = torch.empty(num_frames, 3, image_size, image_size, dtype=torch.float32, device=storage_device)
+        # frames with cached features already have their normalized input in the cache
+        cached_frames, new_frames = [], []
+        for n in range(num_frames):
+            if feature_cache is not None and cache_keys[n] in feature_cache:
+                cached_frames.append(n)
+            else:
+                new_frames.append(n)
+        for n in cached_frames:
+            cached = feature_cache.get(cache_keys[n], storage_device, count=False)
+            if cached is None:
+                new_frames.append(n)
+            else:
+                images[n] = cached[0][0]
+        # resize and normalize the remaining frames as whole batches on the model device
+        new_frames.sort()
+        for start in range(0, len(new_frames), 64):
+            indices = new_frames[start:start + 64]
+            images[indices] = prepare_frames(
+                video_list[indices], image_size, img_mean, img_std, compute_device
+            ).to(storage_device)
         return images, video_height, video_width
     
-    def _convert_img_as_tensor(self, img, image_size):
-        img_pil = Image.fromarray(img)
-        img_np = np.array(img_pil.resize((image_size, image_size)))
-        if img_np.dtype == np.uint8:  # np.uint8 is expected for JPEG images
-            img_np = img_np / 255.0
-        else:
-            raise RuntimeError(f"Unknown image dtype: {img_np.dtype}")
-        img = torch.from_numpy(img_np).permute(2, 0, 1)
-        video_width, video_height = img_pil.size  # the original video size
-        return img, video_height, video_width
-    
     def forward_image(self, img_batch):
         """Get the image feature on the input batch."""
         backbone_out = self.image_encoder(img_batch)
@@ -1028,17 +1301,43 @@ class SAM2VideoPredictorFast(SAM2VideoPredictor):
         offload_video_to_cpu=False,
         offload_state_to_cpu=False,
         async_loading_frames=False,
+        feature_cache=None,
+        frame_indices=None,
+        images=None,
+        video_size=None,
     ):
-        """Initialize an inference state."""
+        """
+        Initialize an inference state.
+        `frame_indices` maps the frames of `video_list` to their index in the video
+        at `video_path` (for sliced or reversed videos), it keys `feature_cache`.
+        `images` are already resized and normalized (T, 3, image_size, image_size)
+        frames (e.g. fp16 from tap_sam/input_store.py) of original `video_size`
+        (height, width); they are used as they are instead of `video_list`.
+        """
         compute_device = self.device  # device of the model
-        images, video_height, video_width = self.load_video_frames(
-            video_list=video_list,
-            image_size=self.image_size,
-            offload_video_to_cpu=offload_video_to_cpu,
-            compute_device=compute_device,
-        )
+        if frame_indices is None:
+            frame_indices = list(range(len(video_list if images is None else images)))
         inference_state = {}
         inference_state["video_path"] = video_path
+        inference_state["frame_indices"] = frame_indices
+        inference_state["feature_cache"] = feature_cache
+        if images is not None:
+            images = torch.as_tensor(images)
+            if not offload_video_to_cpu:
+                images = images.to(compute_device, non_blocking=True)
+            video_height, video_width = video_size
+        else:
+            cache_keys = None
+            if feature_cache is not None:
+                cache_keys = [self._get_feature_cache_key(inference_state, n) for n in range(len(video_list))]
+            images, video_height, video_width = self.load_video_frames(
+                video_list=video_list,
+                image_size=self.image_size,
+                offload_video_to_cpu=offload_video_to_cpu,
+                compute_device=compute_device,
+                feature_cache=feature_cache,
+                cache_keys=cache_keys,
+            )
         inference_state["images"] = images
         inference_state["num_frames"] = len(images)
         # whether to offload the video frames to CPU memory
@@ -1061,7 +1360,7 @@ class SAM2VideoPredictorFast(SAM2VideoPredictor):
         inference_state["point_inputs_per_obj"] = {}
         inference_state["mask_inputs_per_obj"] = {}
         # visual features on a small number of recently visited frames for quick interactions
-        inference_state["cached_features"] = {}
+        inference_state["cached_features"] = self._new_image_feature_cache()
         # values that don't change across frames (so we only need to hold one copy of them)
         inference_state["constants"] = {}
         # mapping between client-side object id and model-side object index
@@ -1087,8 +1386,7 @@ class SAM2VideoPredictorFast(SAM2VideoPredictor):
         # metadata for each tracking frame (e.g. which direction it's tracked)
         inference_state["tracking_has_started"] = False
         inference_state["frames_already_tracked"] = {}
-        inference_state["cached_image_features"] = {}
-        
+
         self._get_image_feature(inference_state, frame_idx=0, batch_size=1)
         
         # cached_feature_path = video_path + "cached_image_features.pkl"
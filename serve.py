@@ -0,0 +1,106 @@
+import os
+import argparse
+import inspect
+import importlib
+import yaml
+from gunicorn.app.base import BaseApplication
+from server_utils import RequestMetrics, ASGIRequestMetrics
+
+# config/config.yaml of the repo, independent of the working directory
+DEFAULT_CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config", "config.yaml")
+# defaults of the `server` section in config/config.yaml
+SERVER_CONFIG = {
+    "host": "0.0.0.0",
+    "port": 10050,
+    "workers": 10,
+    "threads": 8,
+    "keepalive": 5,
+    "backlog": 2048,
+    "timeout": 600,
+    "preload": True,
+    # thread pool of the asyncio workers (server_async.py) for blocking file I/O
+    "io_threads": 64,
+    # workers of the model server (server.py), each holds its own copy of SAM and CoTracker
+    "model_workers": 1,
+    "warmup": True,
+    # decoded-frame cache of the model server, spill files go next to the videos without frame_cache_dir
+    "frame_cache_gb": 16,
+    "frame_cache_dir": None,
+}
+
+
+def load_server_config(config_path=DEFAULT_CONFIG_PATH):
+    with open(config_path) as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    server_config = dict(SERVER_CONFIG)
+    server_config.update(config.get("server") or {})
+    return server_config
+
+
+class WorkerPool(BaseApplication):
+    """
+    Pre-forked gunicorn pool serving one WSGI or ASGI app on a single port.
+
+    Every worker runs `threads` request threads (gthread), or an event loop
+    for ASGI apps (uvicorn), the kernel balances new connections between the
+    workers through the shared listen socket.
+    """
+
+    def __init__(self, app, server_config, worker_class="gthread", post_fork=None):
+        self.application = app
+        self.server_config = server_config
+        self.worker_class = worker_class
+        self.post_fork = post_fork
+        super().__init__()
+
+    def load_config(self):
+        config = self.server_config
+        options = {
+            "bind": f"{config['host']}:{config['port']}",
+            "workers": config["workers"],
+            "worker_class": self.worker_class,
+            "threads": config["threads"],
+            "keepalive": config["keepalive"],
+            "backlog": config["backlog"],
+            # video downloads and SAM requests take far longer than the 30s default
+            "timeout": config["timeout"],
+            # load the app once in the master so the metrics counters are shared by the workers
+            "preload_app": config["preload"],
+        }
+        if self.post_fork is not None:
+            # per-worker setup (models, cuda) that must not run in the master before fork
+            options["post_fork"] = self.post_fork
+        for key, value in options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+def serve(app, server_config, post_fork=None):
+    if inspect.iscoroutinefunction(type(app).__call__):
+        WorkerPool(ASGIRequestMetrics(app), server_config, "uvicorn.workers.UvicornWorker", post_fork).run()
+    else:
+        WorkerPool(RequestMetrics(app), server_config, post_fork=post_fork).run()
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser()
+    args.add_argument("--app", type=str, default="server_multi", choices=["server_multi", "server_async", "server"])
+    args.add_argument("--config", type=str, default=DEFAULT_CONFIG_PATH)
+    args.add_argument("--port", type=int, default=None)
+    args.add_argument("--workers", type=int, default=None)
+    args.add_argument("--threads", type=int, default=None)
+    args = args.parse_args()
+
+    server_config = load_server_config(args.config)
+    module = importlib.import_module(args.app)
+    # the apps read their own settings (models, io threads) from the same config
+    module.CONFIG_PATH = args.config
+    start_models = getattr(module, "start_models", None)
+    if start_models is not None:
+        server_config["workers"] = server_config["model_workers"]
+    for key in ["port", "workers", "threads"]:
+        if getattr(args, key) is not None:
+            server_config[key] = getattr(args, key)
+    serve(module.app, server_config, post_fork=start_models)
@@ -1,33 +1,173 @@
-import io, zipfile, json, os, pickle
+import io, zipfile, json, os, pickle, queue, tempfile
 import numpy as np
 import yaml, torch
-from flask import Flask, request, send_file
+from flask import Flask, Response, request, send_file
 from tap_sam.sam import Sam
-from tap_sam.vis_utils import extract_frames, save_multi_frames
+from tap_sam.scheduler import SamScheduler
+from tap_sam.feature_cache import FeatureCache
+from tap_sam.input_store import InputStore
+from tap_sam import frame_cache
+from tap_sam.frame_cache import FrameCache, set_frame_cache
+from tap_sam.vis_utils import extract_sam_frames, save_multi_frames, read_video_from_path
+from tap_sam import mask_stream
+from tap_sam.mask_io import encode_masks, read_masks
+from server_utils import send_zip_stream
+from serve import serve, load_server_config
 from cotracker.predictor import CoTrackerPredictor
-from cotracker.utils.visualizer import read_video_from_path, Visualizer
-import multiprocessing
+from cotracker.utils.visualizer import Visualizer
+import threading
 import portalocker
 
 app = Flask(__name__)
-model_sam, model_cotracker = None, None
+model_sam, model_cotracker, model_device = None, None, None
+# only the scheduler thread runs model_sam, requests queue their objects on it
+sam_scheduler = None
+# resized and normalized SAM inputs of requested videos, see sam.input_store in the config
+input_store = None
 ROOT_DIR = '/mnt/hwfile/OpenRobotLab/Annotation4Manipulation'
+CONFIG_PATH = "./config/config.yaml"
+# set once the models of this worker are loaded and warmed up, see /ready
+MODELS_READY = threading.Event()
+MODEL_ERROR = None
+# request threads of a worker share one cotracker
+MODEL_LOCK = threading.Lock()
+# tracked frames of /predict_sam_stream waiting for the client, the pass waits when it is full
+STREAM_QUEUE_SIZE = 32
 
-def forward_sam(model_config):
+# gpu slot lock of this worker, held open until the process exits
+GPU_LOCK = None
+
+def claim_gpu(num_gpus, lock_dir):
+    """
+    Index of the gpu of this worker. Slot s of gpu i is the lock file
+    `lock_dir/gpu{i}.{s}.lock`; the worker takes the first free one going over all
+    gpus for slot 0, then for slot 1 and so on, so N workers on G gpus get
+    gpus 0..G-1, then 0..G-1 again. The kernel drops the lock when the worker
+    exits (crash, max_requests, reload), so its replacement gets the same gpu.
+    """
+    global GPU_LOCK
+    os.makedirs(lock_dir, exist_ok=True)
+    slot = 0
+    while True:
+        for gpu in range(num_gpus):
+            f = open(os.path.join(lock_dir, f"gpu{gpu}.{slot}.lock"), "a")
+            try:
+                portalocker.lock(f, portalocker.LOCK_EX | portalocker.LOCK_NB)
+            except portalocker.LockException:
+                f.close()
+                continue
+            GPU_LOCK = f
+            return gpu
+        slot += 1
+
+def get_worker_device(device, lock_dir):
+    if device.startswith("cuda") and not torch.cuda.is_available():
+        # gpu-less overflow servers run both models on the cpu
+        return "cpu"
+    # spread the workers of a multi-gpu node over the gpus
+    if device == "cuda" and torch.cuda.device_count() > 1:
+        return f"cuda:{claim_gpu(torch.cuda.device_count(), lock_dir)}"
+    return device
+
+@torch.inference_mode()
+def warmup_models():
+    # one tiny request through each model, so cudnn autotuning and lazy
+    # allocations happen here and not in the first annotator request
+    video = np.zeros((2, 256, 256, 3), dtype=np.uint8)
+    model_sam.set_video_list(video, "warmup")
+    model_sam([np.array([[128, 128]])], [np.array([1])], 0, [1])
+    video = torch.zeros(1, 8, 3, 256, 256, device=model_device)
+    model_cotracker(video, grid_size=5)
+    if model_device.startswith("cuda"):
+        torch.cuda.synchronize(model_device)
+
+def load_models(config_path=None):
+    global model_sam, model_cotracker, model_device, sam_scheduler, input_store, MODEL_ERROR
+    config_path = config_path or CONFIG_PATH
+    try:
+        with open(config_path) as f:
+            model_config = yaml.load(f, Loader=yaml.FullLoader)
+        sam_config = model_config["sam"]
+        co_tracker_config = model_config["cotracker"]
+
+        server_config = load_server_config(config_path)
+        # one set of gpu locks per server port on the node
+        lock_dir = os.path.join(tempfile.gettempdir(), f"tap_sam_gpus_{server_config['port']}")
+        model_device = get_worker_device(sam_config["device"], lock_dir)
+        if model_device.startswith("cuda"):
+            torch.cuda.set_device(model_device)
+        # decoded frames of hot videos, shared by /predict_sam and /predict_cotracker
+        if server_config["frame_cache_gb"] > 0:
+            set_frame_cache(FrameCache(int(server_config["frame_cache_gb"] * (1 << 30)), server_config["frame_cache_dir"]))
+        # image features of recently requested videos, reused while annotators refine their clicks
+        feature_cache = FeatureCache(
+            int(sam_config.get("feature_cache_gb", 4) * (1 << 30)),
+            offload_to_cpu=sam_config.get("feature_cache_offload", False),
+        )
+        model_sam = Sam(
+            sam_config["sam_ckpt_path"],
+            sam_config["model_config"],
+            sam_config["threshold"],
+            False,
+            model_device,
+            feature_cache=feature_cache,
+            image_feature_cache_size=sam_config.get("image_feature_cache_size", 64),
+            image_feature_cache_device=sam_config.get("image_feature_cache_device", None),
+            prefetch_batch_size=sam_config.get("prefetch_batch_size", 0),
+            precision=sam_config.get("precision", "fp32"),
+            compile=sam_config.get("compile", False),
+            channels_last=sam_config.get("channels_last", False),
+            num_threads=sam_config.get("num_threads", None),
+            offload_video_to_cpu=sam_config.get("offload_video_to_cpu", False),
+            offload_state_to_cpu=sam_config.get("offload_state_to_cpu", False),
+            quantize_int8=model_device == "cpu" and sam_config.get("quantize_int8", False),
+            cpu_model_cfg=sam_config.get("cpu_model_config", None),
+            cpu_checkpoint=sam_config.get("cpu_sam_ckpt_path", None),
+        )
+        if sam_config.get("input_store", False):
+            input_store = InputStore(
+                model_sam.predictor.image_size, sam_config.get("input_store_dir", None), device=model_device
+            )
+        model_cotracker = CoTrackerPredictor(
+            checkpoint=co_tracker_config["cotracker_ckpt_path"]
+        ).to(model_device).eval()
+        if server_config["warmup"]:
+            warmup_models()
+        sam_scheduler = SamScheduler(
+            model_sam,
+            max_wait=sam_config.get("batch_max_wait", 0.02),
+            max_objects=sam_config.get("batch_max_objects", 32),
+            stream_timeout=sam_config.get("stream_timeout", 30.0),
+        )
+        MODELS_READY.set()
+    except Exception as e:
+        MODEL_ERROR = repr(e)
+        raise
+
+def start_models(server=None, worker=None):
+    # gunicorn post_fork hook: load in the background so /health answers while loading
+    # the gpu is picked from per-gpu lock files, see claim_gpu
+    threading.Thread(target=load_models, daemon=True).start()
+
+def submit_sam(model_config, frame_queue=None):
+    """
+    Queue a SAM request on the scheduler. Returns the future of its masks and
+    their (num_objects, num_frames, height, width).
+    """
     video_path = model_config["video_path"]
     is_video = model_config["is_video"]
     select_frame = model_config["select_frame"]
     direction = model_config["direction"]
 
     temp_image_list_save_dir = video_path.rsplit(".", 1)[0]
-    video = extract_frames(video_path)
-    if not is_video:
-        video = video[select_frame:select_frame + 1]
-    elif direction == "forward":
-        video = video[select_frame:]     
-    elif direction == "backward":
-        video = video[:select_frame+1][::-1]
-    select_frame = 0
+    # only the tracked frames are decoded, frame_indices (their index in the
+    # full video) keys the feature cache
+    video, frame_indices = extract_sam_frames(video_path, select_frame, is_video, direction)
+    window = (is_video, select_frame, direction)
+    # bidirection tracks both ways from select_frame on the full video
+    bidirectional = is_video and direction == "bidirection"
+    if not bidirectional:
+        select_frame = 0
     
     # os.system(f"rm -rf {temp_image_list_save_dir}")
     # save_multi_frames(video, temp_image_list_save_dir)
@@ -36,9 +176,10 @@ def forward_sam(model_config):
     negative_points_dict = model_config["negative_points"]
     labels_dict = model_config["labels"]
     
-    mask_all = []
-    global model_sam
-    model_sam.set_video_list(video, temp_image_list_save_dir)
+    # all objects in one job: they are registered on one inference state and
+    # propagated together, the scheduler may add objects of other requests on
+    # the same video window to the same pass
+    objects = []
     for obj_idx in positive_points_dict.keys():
         positive_points = np.array(positive_points_dict[obj_idx])
         negative_points = np.array(negative_points_dict[obj_idx])
@@ -46,9 +187,29 @@ def forward_sam(model_config):
 
         if len(negative_points) != 0:
             positive_points = np.concatenate([positive_points, negative_points], axis=0)
-    
-        masks = model_sam(positive_points, labels, select_frame, obj_idx)
-        mask_all.append(masks)
+        objects.append((positive_points, labels))
+    
+    images, video_size = None, None
+    if input_store is not None:
+        # the first request on a video preprocesses all of its frames, later ones map them
+        images, video_size = input_store.read(video_path, frame_indices)
+    future = sam_scheduler.submit(
+        video,
+        temp_image_list_save_dir,
+        window,
+        objects,
+        frame_indices,
+        select_frame,
+        bidirectional,
+        images,
+        video_size,
+        frame_queue,
+    )
+    return future, (len(objects), len(video), video.shape[1], video.shape[2])
+
+def forward_sam(model_config):
+    future, _ = submit_sam(model_config)
+    mask_all = list(future.result())
    
     # mask_images = model_sam.get_mask_on_image(
     #     mask_all, video, save_path=model_config["save_path"], obj_id=list(positive_points_dict.keys())
@@ -58,19 +219,10 @@ def forward_sam(model_config):
     return mask_all
 
 def bidirectional_sam(model_config):
-    model_config["direction"] = "forward"
-    masks_forward = forward_sam(model_config)
-    if model_config['select_frame'] == 0:
-        return masks_forward
-    model_config["direction"] = "backward"
-    masks_backward = forward_sam(model_config)
-    
-    # mask_image = mask_images_backward[::-1][:-1] + mask_images_forward
-    masks = []
-    for obj_id in range(len(masks_forward)):
-        masks.append(np.concatenate([masks_backward[obj_id][::-1][:-1], masks_forward[obj_id]], axis=0))
-    
-    return masks
+    # one inference state on the full video, propagated forward and then backward
+    # from select_frame, instead of two forward_sam calls on sliced copies
+    model_config["direction"] = "bidirection"
+    return forward_sam(model_config)
         
 def forward_co_tracker(model_config):
     video_path = model_config["cotracker"]["video_path"]
@@ -80,15 +232,14 @@ def forward_co_tracker(model_config):
     track_mode = model_config["cotracker"]["track_mode"]
     
     video = read_video_from_path(video_path)
+    # the model is pinned to its device at startup, the requested device is ignored
+    device = model_device
     video = torch.from_numpy(video).permute(0, 3, 1, 2).unsqueeze(0).float().to(device)
     
     if track_mode == 'Forward':
         video = video[:, select_frame[0][0]:]
         select_frame = [[0] for _ in range(len(select_frame))]
     
-    global model_cotracker
-    model_cotracker = model_cotracker.to(device)
-    
     if mode == "Mask Mode":
         assert model_config["sam"]["is_video"] == False, "mask mode only support single frame"
         sample_points_number = model_config["cotracker"]["sample_points_number"]
@@ -142,33 +293,88 @@ def forward_co_tracker(model_config):
         
     return pred_tracks, pred_visibility, res_video
 
+@app.route("/health", methods=["GET"])
+def health():
+    return "ok"
+
+@app.route("/ready", methods=["GET"])
+def ready():
+    if MODELS_READY.is_set():
+        return "ready"
+    return MODEL_ERROR or "loading", 503
+
+@app.route("/cache_stats", methods=["GET"])
+def cache_stats():
+    # cache counters of this worker, /metrics counts the requests of all workers
+    stats = {"pid": os.getpid()}
+    if frame_cache.FRAME_CACHE is not None:
+        stats["frame_cache"] = frame_cache.FRAME_CACHE.stats()
+    if input_store is not None:
+        stats["input_store"] = input_store.stats()
+    if model_sam is not None:
+        stats.update(model_sam.cache_stats())
+    return stats
+
 @app.route("/predict_sam", methods=["POST"])
 def predict_sam_video():
+    if not MODELS_READY.is_set():
+        return MODEL_ERROR or "loading", 503
     # get parameters
     model_config = json.loads(request.data)
     if model_config["direction"] == "bidirection":
         masks = bidirectional_sam(model_config)
     else:
         masks = forward_sam(model_config)
-    zip_io = io.BytesIO()
-    with zipfile.ZipFile(zip_io, "w") as zf:
-        # with zf.open("mask_images.npy", "w") as f:
-        #     np.save(f, mask_images)
-        with zf.open("masks.npy", "w") as f:
-            np.save(f, masks)
-
-    zip_io.seek(0)
+    # bit-packed mask file, see tap_sam/mask_io.py
     return send_file(
-        zip_io,
-        mimetype="application/zip",
+        io.BytesIO(encode_masks(masks)),
+        mimetype="application/octet-stream",
         as_attachment=True,
-        download_name="arrays.zip",
+        download_name="masks.masks",
     )
 
+@app.route("/predict_sam_stream", methods=["POST"])
+def predict_sam_stream():
+    # same request as /predict_sam, the masks of every frame are sent as soon as
+    # they are tracked, see tap_sam/mask_stream.py for the records
+    if not MODELS_READY.is_set():
+        return MODEL_ERROR or "loading", 503
+    model_config = json.loads(request.data)
+    frame_queue = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+    future, (num_objects, num_frames, height, width) = submit_sam(model_config, frame_queue)
+
+    def records():
+        try:
+            yield mask_stream.encode_header(
+                {"num_objects": num_objects, "num_frames": num_frames, "height": height, "width": width}
+            )
+            while True:
+                try:
+                    item = frame_queue.get(timeout=1.0)
+                except queue.Empty:
+                    # a job that timed out on this queue gets no closing None
+                    if future.done() and frame_queue.empty():
+                        break
+                    continue
+                if item is None:
+                    break
+                frame_idx, masks = item
+                yield mask_stream.encode_record(mask_stream.FRAME, mask_stream.encode_frame(masks), frame_idx)
+            if future.exception() is not None:
+                yield mask_stream.encode_error(repr(future.exception()))
+        finally:
+            # the client went away (GeneratorExit), stop tracking for it; no-op once done
+            future.cancel()
+
+    return Response(records(), mimetype="application/octet-stream")
+
 @app.route("/predict_cotracker", methods=["POST"])
 def predict_cotracker():
+    if not MODELS_READY.is_set():
+        return MODEL_ERROR or "loading", 503
     model_config = json.loads(request.data)
-    pred_tracks, pred_visibility, images = forward_co_tracker(model_config)
+    with MODEL_LOCK:
+        pred_tracks, pred_visibility, images = forward_co_tracker(model_config)
     zip_io = io.BytesIO()
     with zipfile.ZipFile(zip_io, "w") as zf:
         with zf.open("pred_tracks.npy", "w") as f:
@@ -209,16 +415,13 @@ def predict_cotracker():
 def get_mask():
     config = json.loads(request.data)
     video_path = config["video_path"]
-    mask_path = video_path.rsplit(".", 1)[0] + "mask.npz"
-    masks = np.load(mask_path)['masks']
+    mask_path = video_path.rsplit(".", 1)[0] + "mask.masks"
+    masks = read_masks(mask_path)
     config = np.load('/mnt/petrelfs/wangziqin/project/tracker_tools/data/sam_input_anno.pkl', allow_pickle=True)
     config = config[video_path.split("/")[-1]]
     zip_io = io.BytesIO()
     with zipfile.ZipFile(zip_io, "w") as zf:
-        npz_io = io.BytesIO()
-        np.savez_compressed(npz_io, masks=masks)
-        npz_io.seek(0)
-        zf.writestr("masks.npy", npz_io.getvalue())
+        zf.writestr("masks.masks", encode_masks(masks))
         zf.writestr("config.json", json.dumps(config))
     
     zip_io.seek(0)
@@ -258,32 +461,22 @@ def get_video_and_anno_lang():
         if mode == 'pre':
             video_path = history[-1].strip()
     
-    zip_io = io.BytesIO()
-    with zipfile.ZipFile(zip_io, "w") as zf:
-        if not is_finished:
-            with zf.open("video.mp4", "w") as f:
-                with open(video_path, "rb") as video_file:
-                    f.write(video_file.read())
-            npz_io = io.BytesIO()
-            anno_file = np.load(has_annotation[video_path]['anno_path'], allow_pickle=True)
-            np.savez_compressed(npz_io, anno_file=anno_file['data'])
-            npz_io.seek(0)
-            zf.writestr("anno.npz", npz_io.getvalue())
-            save_path = has_annotation[video_path]['save_path'].rsplit('/', 1)[0]
-            save_file_name = has_annotation[video_path]['save_path'].split('/')[-1].split('.')[0]
-            save_path = os.path.join(save_path, 'lang', save_file_name)
-            zf.writestr("save_path", save_path)
-            zf.writestr("video_path", video_path)
-            zf.writestr("history_number", str(len(history)))
-        zf.writestr("is_finished", str(is_finished))
-            
-    zip_io.seek(0)
-    return send_file(
-        zip_io,
-        mimetype="application/zip",
-        as_attachment=True,
-        download_name="video_and_anno_lang.zip",
-    )
+    entries, files = [], []
+    if not is_finished:
+        npz_io = io.BytesIO()
+        anno_file = np.load(has_annotation[video_path]['anno_path'], allow_pickle=True)
+        np.savez_compressed(npz_io, anno_file=anno_file['data'])
+        entries.append(("anno.npz", npz_io.getvalue()))
+        save_path = has_annotation[video_path]['save_path'].rsplit('/', 1)[0]
+        save_file_name = has_annotation[video_path]['save_path'].split('/')[-1].split('.')[0]
+        save_path = os.path.join(save_path, 'lang', save_file_name)
+        entries.append(("save_path", save_path))
+        entries.append(("video_path", video_path))
+        entries.append(("history_number", str(len(history))))
+        files.append(("video.mp4", video_path))
+    entries.append(("is_finished", str(is_finished)))
+    
+    return send_zip_stream(entries, files, download_name="video_and_anno_lang.zip")
 
 @app.route("/get_video_and_anno_sam", methods=["POST"])
 def get_video_and_anno_sam():
@@ -316,28 +509,19 @@ def get_video_and_anno_sam():
         if mode == 'pre':
             video_path = history[-1].strip()
     
-    zip_io = io.BytesIO()
-    with zipfile.ZipFile(zip_io, "w") as zf:
-        if not is_finished:
-            with zf.open("video.mp4", "w") as f:
-                with open(video_path, "rb") as video_file:
-                    f.write(video_file.read())
-            # send save path
-            save_path = has_annotation[video_path]['save_path'].rsplit('/', 1)[0]
-            save_file_name = has_annotation[video_path]['save_path'].split('/')[-1].split('.')[0]
-            save_path = os.path.join(save_path, 'sam', save_file_name)
-            zf.writestr("save_path", save_path)
-            zf.writestr("video_path", video_path)
-            zf.writestr("history_number", str(len(history)))
-        zf.writestr("is_finished", str(is_finished))
-    
-    zip_io.seek(0)
-    return send_file(
-        zip_io,
-        mimetype="application/zip",
-        as_attachment=True,
-        download_name="video_and_anno_sam.zip",
-    )
+    entries, files = [], []
+    if not is_finished:
+        # send save path
+        save_path = has_annotation[video_path]['save_path'].rsplit('/', 1)[0]
+        save_file_name = has_annotation[video_path]['save_path'].split('/')[-1].split('.')[0]
+        save_path = os.path.join(save_path, 'sam', save_file_name)
+        entries.append(("save_path", save_path))
+        entries.append(("video_path", video_path))
+        entries.append(("history_number", str(len(history))))
+        files.append(("video.mp4", video_path))
+    entries.append(("is_finished", str(is_finished)))
+    
+    return send_zip_stream(entries, files, download_name="video_and_anno_sam.zip")
 
 @app.route("/save_anno", methods=["POST"])
 def save_anno():
@@ -388,26 +572,8 @@ def save_anno():
     
     return "success"
             
-def run_on_port(port):
-    app.run(host="0.0.0.0", port=port)
-
 if __name__ == "__main__":
-
-    # with open("./config/config.yaml") as f:
-    #     model_config = yaml.load(f, Loader=yaml.FullLoader)
-
-    # sam_config = model_config["sam"]
-    # co_tracker_config = model_config["cotracker"]
-    
-    # model_sam = Sam(
-    #     sam_config["sam_ckpt_path"],
-    #     sam_config["model_config"],
-    #     sam_config["threshold"],
-    #     False,
-    #     sam_config["device"],
-    # )
-
-    # model_cotracker = CoTrackerPredictor(
-    #     checkpoint=co_tracker_config["cotracker_ckpt_path"]
-    # )
-    run_on_port(10087)
\ No newline at end of file
+    server_config = load_server_config()
+    server_config["port"] = 10087
+    server_config["workers"] = server_config["model_workers"]
+    serve(app, server_config, post_fork=start_models)
@@ -0,0 +1,82 @@
+import json
+import contextlib
+import anyio.to_thread
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool, iterate_in_threadpool
+from starlette.responses import PlainTextResponse, StreamingResponse
+from starlette.routing import Route
+from server_utils import iter_zip
+from server_multi import get_lang_task, get_sam_task, save_anno_file, drawback_video
+from serve import serve, load_server_config, DEFAULT_CONFIG_PATH
+
+# the task endpoints of server_multi.py on an event loop: every blocking call
+# (sqlite, history journals, np.load/np.savez and the mp4 reads on /mnt/hwfile)
+# runs in the thread pool, so a slow filesystem only holds a pool thread while
+# hundreds of idle annotator connections cost nothing
+
+# set by serve.py --config
+CONFIG_PATH = DEFAULT_CONFIG_PATH
+
+
+def send_zip_stream(entries, files, download_name):
+    chunks = (chunk for chunk in iter_zip(entries, files) if chunk)
+    return StreamingResponse(
+        iterate_in_threadpool(chunks),
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename={download_name}"},
+    )
+
+
+async def get_video_and_anno_lang(request):
+    config = json.loads(await request.body())
+    entries, files = await run_in_threadpool(get_lang_task, config)
+    return send_zip_stream(entries, files, download_name="video_and_anno_lang.zip")
+
+
+async def get_video_and_anno_sam(request):
+    config = json.loads(await request.body())
+    entries, files = await run_in_threadpool(get_sam_task, config)
+    return send_zip_stream(entries, files, download_name="video_and_anno_sam.zip")
+
+
+async def save_anno(request):
+    async with request.form() as form:
+        file_content = await form["file"].read()
+        save_path = form.get("save_path")
+    await run_in_threadpool(save_anno_file, file_content, save_path)
+    return PlainTextResponse("success")
+
+
+async def drawback_video_sam(request):
+    config = json.loads(await request.body())
+    await run_in_threadpool(drawback_video, "sam", config["video_path"])
+    return PlainTextResponse("success")
+
+
+async def drawback_video_lang(request):
+    config = json.loads(await request.body())
+    await run_in_threadpool(drawback_video, "lang", config["video_path"])
+    return PlainTextResponse("success")
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # anyio allows 40 threads by default, too few when the filesystem stalls
+    anyio.to_thread.current_default_thread_limiter().total_tokens = load_server_config(CONFIG_PATH)["io_threads"]
+    yield
+
+
+app = Starlette(
+    routes=[
+        Route("/get_video_and_anno_lang", get_video_and_anno_lang, methods=["POST"]),
+        Route("/get_video_and_anno_sam", get_video_and_anno_sam, methods=["POST"]),
+        Route("/save_anno", save_anno, methods=["POST"]),
+        Route("/drawback_video_sam", drawback_video_sam, methods=["POST"]),
+        Route("/drawback_video_lang", drawback_video_lang, methods=["POST"]),
+    ],
+    lifespan=lifespan,
+)
+
+
+if __name__ == "__main__":
+    serve(app, load_server_config(CONFIG_PATH))
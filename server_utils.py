@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import zipfile
+import multiprocessing
+from flask import Response
+
+# read size for streaming video files, also the largest chunk kept in memory per request
+CHUNK_SIZE = 1 << 20
+
+
+class _StreamBuffer:
+    # write-only sink without tell/seek, zipfile falls back to streaming mode
+    # (data descriptors after each member) when the output is not seekable
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def iter_zip(entries, files=(), chunk_size=CHUNK_SIZE):
+    """
+    Yield a ZIP_STORED archive piece by piece.
+    `entries` are (name, str or bytes) pairs, `files` are (name, path) pairs that are
+    copied chunk by chunk, so memory stays at one chunk whatever the file size.
+    """
+    buffer = _StreamBuffer()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as zf:
+        for name, data in entries:
+            zf.writestr(name, data)
+        yield buffer.drain()
+        for name, path in files:
+            zinfo = zipfile.ZipInfo(name, date_time=time.localtime(os.path.getmtime(path))[:6])
+            # known size lets zipfile decide on zip64 before the data is written
+            zinfo.file_size = os.path.getsize(path)
+            with open(path, "rb") as src, zf.open(zinfo, "w") as dst:
+                while True:
+                    chunk = src.read(chunk_size)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    yield buffer.drain()
+    yield buffer.drain()
+
+
+def send_zip_stream(entries, files=(), download_name="archive.zip"):
+    chunks = (chunk for chunk in iter_zip(entries, files) if chunk)
+    return Response(
+        chunks,
+        mimetype="application/zip",
+        headers={"Content-Disposition": f"attachment; filename={download_name}"},
+    )
+
+
+class RequestMetrics:
+    """
+    WSGI middleware that counts requests of all workers and serves them on /metrics.
+
+    The counters live in shared memory created before the workers are forked
+    (the pool preloads the app), so every worker updates the same numbers.
+    `queue_*` is only filled when a front proxy sets X-Request-Start
+    (nginx: proxy_set_header X-Request-Start "t=${msec}").
+    """
+
+    def __init__(self, app, path="/metrics"):
+        self.app = app
+        self.path = path
+        self.lock = multiprocessing.Lock()
+        self.in_flight = multiprocessing.Value("q", 0, lock=False)
+        self.peak_in_flight = multiprocessing.Value("q", 0, lock=False)
+        self.requests = multiprocessing.Value("q", 0, lock=False)
+        self.errors = multiprocessing.Value("q", 0, lock=False)
+        self.total_time = multiprocessing.Value("d", 0.0, lock=False)
+        self.max_time = multiprocessing.Value("d", 0.0, lock=False)
+        self.queued_requests = multiprocessing.Value("q", 0, lock=False)
+        self.queue_time = multiprocessing.Value("d", 0.0, lock=False)
+        self.max_queue_time = multiprocessing.Value("d", 0.0, lock=False)
+
+    @staticmethod
+    def _queue_time(environ, now):
+        value = environ.get("HTTP_X_REQUEST_START", "")
+        if value.startswith("t="):
+            value = value[2:]
+        try:
+            start = float(value)
+        except ValueError:
+            return None
+        # nginx sends seconds with ms resolution, other proxies send microseconds
+        if start > 1e12:
+            start /= 1e6
+        return max(now - start, 0.0)
+
+    def snapshot(self):
+        with self.lock:
+            requests, queued = self.requests.value, self.queued_requests.value
+            return {
+                "pid": os.getpid(),
+                "in_flight": self.in_flight.value,
+                "peak_in_flight": self.peak_in_flight.value,
+                "requests": requests,
+                "errors": self.errors.value,
+                "mean_time": self.total_time.value / requests if requests > 0 else 0.0,
+                "max_time": self.max_time.value,
+                "queued_requests": queued,
+                "mean_queue_time": self.queue_time.value / queued if queued > 0 else 0.0,
+                "max_queue_time": self.max_queue_time.value,
+            }
+
+    def _start(self, environ):
+        start = time.time()
+        queue_time = self._queue_time(environ, start)
+        with self.lock:
+            self.in_flight.value += 1
+            self.peak_in_flight.value = max(self.peak_in_flight.value, self.in_flight.value)
+            if queue_time is not None:
+                self.queued_requests.value += 1
+                self.queue_time.value += queue_time
+                self.max_queue_time.value = max(self.max_queue_time.value, queue_time)
+        return start
+
+    def _finish(self, start, status):
+        elapsed = time.time() - start
+        with self.lock:
+            self.in_flight.value -= 1
+            self.requests.value += 1
+            if status is None or status >= 500:
+                self.errors.value += 1
+            self.total_time.value += elapsed
+            self.max_time.value = max(self.max_time.value, elapsed)
+
+    def __call__(self, environ, start_response):
+        if environ.get("PATH_INFO") == self.path:
+            body = json.dumps(self.snapshot()).encode("utf-8")
+            start_response("200 OK", [("Content-Type", "application/json"), ("Content-Length", str(len(body)))])
+            return [body]
+
+        start = self._start(environ)
+
+        status = []
+        def _start_response(status_line, headers, exc_info=None):
+            status.append(int(status_line.split(" ", 1)[0]))
+            return start_response(status_line, headers, exc_info)
+
+        try:
+            result = self.app(environ, _start_response)
+        except Exception:
+            self._finish(start, None)
+            raise
+        # streamed responses are only done once the server closes the iterable
+        return _ClosingIterator(result, lambda: self._finish(start, status[-1] if status else None))
+
+
+class _ClosingIterator:
+    def __init__(self, iterable, callback):
+        self.iterable = iterable
+        self.callback = callback
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, "close"):
+                self.iterable.close()
+        finally:
+            self.callback()
+
+
+class ASGIRequestMetrics(RequestMetrics):
+    """Same counters for ASGI apps, one in-flight request per open http scope."""
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        if scope["path"] == self.path:
+            body = json.dumps(self.snapshot()).encode("utf-8")
+            await send({"type": "http.response.start", "status": 200,
+                        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]})
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        headers = dict(scope.get("headers") or [])
+        start = self._start({"HTTP_X_REQUEST_START": headers.get(b"x-request-start", b"").decode("latin-1")})
+
+        status = []
+        async def _send(message):
+            if message["type"] == "http.response.start":
+                status.append(message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            self._finish(start, status[-1] if status else None)
@@ -0,0 +1,96 @@
+import threading
+import torch
+from collections import OrderedDict
+
+
+def get_nbytes(value):
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, (list, tuple)):
+        return sum(get_nbytes(v) for v in value)
+    if isinstance(value, dict):
+        return sum(get_nbytes(v) for v in value.values())
+    return 0
+
+
+def to_device(value, device, non_blocking=False):
+    if isinstance(value, torch.Tensor):
+        if device.type == "cpu" and value.device.type == "cuda":
+            return value.to(device).pin_memory()
+        return value.to(device, non_blocking=non_blocking)
+    if isinstance(value, (list, tuple)):
+        return type(value)(to_device(v, device, non_blocking) for v in value)
+    if isinstance(value, dict):
+        return {k: to_device(v, device, non_blocking) for k, v in value.items()}
+    return value
+
+
+class FeatureCache:
+    """
+    LRU cache of SAM2 frame inputs and image-encoder features shared by all requests of a worker.
+
+    Entries are keyed by (video_path, frame_idx, image_size) and hold the
+    normalized input image and the backbone features of that frame, so a new
+    request on a cached frame skips resizing and the image encoder. Entries
+    are evicted oldest first once they take more than `max_bytes`. With
+    `offload_to_cpu` the entries are kept in pinned CPU memory and copied to
+    the model device on every hit.
+    """
+
+    def __init__(self, max_bytes, offload_to_cpu=False):
+        self.max_bytes = max_bytes
+        self.offload_to_cpu = offload_to_cpu
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "nbytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def get(self, key, device=None, count=True):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += count
+                return None
+            self._entries.move_to_end(key)
+            self.hits += count
+        value, _ = entry
+        if self.offload_to_cpu and device is not None:
+            value = to_device(value, torch.device(device), non_blocking=True)
+        return value
+
+    def put(self, key, value):
+        if self.offload_to_cpu:
+            value = to_device(value, torch.device("cpu"))
+        nbytes = get_nbytes(value)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            while self.nbytes + nbytes > self.max_bytes and len(self._entries) > 0:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.nbytes -= evicted
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
@@ -0,0 +1,115 @@
+import os
+import cv2
+import threading
+import numpy as np
+from collections import OrderedDict
+from tap_sam.video_io import read_video
+
+# process-wide cache used by extract_frames / read_video_from_path, see set_frame_cache
+FRAME_CACHE = None
+
+
+def set_frame_cache(frame_cache):
+    global FRAME_CACHE
+    FRAME_CACHE = frame_cache
+    return frame_cache
+
+
+class FrameCache:
+    """
+    Decoded frames of recently used videos, spilled to .npy files and memory-mapped.
+
+    The first read of a video decodes it once (BGR, the layout of the SAM path) into `.<name>.frames.npy`
+    next to the video, or under `cache_dir` when given; later reads of any
+    frame range are a slice of the memory map. The spill file carries the
+    mtime of its video, a re-written video is decoded again. Videos are
+    dropped oldest first once the cached frames take more than `max_bytes`,
+    spill files this process created are deleted then; other processes
+    reading the same file keep their mapping.
+    """
+
+    def __init__(self, max_bytes, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_spill_path(self, video_path):
+        video_dir, video_name = os.path.split(os.path.abspath(video_path))
+        if self.cache_dir is not None:
+            # flatten the video path so equal names in different folders do not collide
+            video_dir = self.cache_dir
+            video_name = os.path.abspath(video_path).strip("/").replace("/", "_")
+        return os.path.join(video_dir, f".{video_name}.frames.npy")
+
+    def _open(self, video_path, mtime):
+        spill_path = self.get_spill_path(video_path)
+        try:
+            if os.stat(spill_path).st_mtime_ns == mtime:
+                return np.load(spill_path, mmap_mode="r"), spill_path, False
+        except (FileNotFoundError, ValueError):
+            pass
+        frames = read_video(video_path, rgb=False)
+        tmp_path = f"{spill_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(spill_path), exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                np.save(f, frames)
+            # the spill file is valid as long as its mtime equals the video's
+            os.utime(tmp_path, ns=(mtime, mtime))
+            os.replace(tmp_path, spill_path)
+        except OSError:
+            # read-only video folder: serve the decoded frames without spilling
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return frames, None, True
+        return np.load(spill_path, mmap_mode="r"), spill_path, True
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes and len(self._frames) > 1:
+            _, (_, frames, spill_path, created) = self._frames.popitem(last=False)
+            self.nbytes -= frames.nbytes
+            if created and spill_path is not None and os.path.exists(spill_path):
+                os.remove(spill_path)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._frames),
+                "nbytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def get(self, video_path):
+        """All frames of `video_path` as a read-only (T, H, W, 3) BGR array."""
+        mtime = os.stat(video_path).st_mtime_ns
+        with self._lock:
+            entry = self._frames.get(video_path)
+            if entry is not None and entry[0] == mtime:
+                self._frames.move_to_end(video_path)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        frames, spill_path, created = self._open(video_path, mtime)
+        with self._lock:
+            old = self._frames.pop(video_path, None)
+            if old is not None:
+                self.nbytes -= old[1].nbytes
+            self._frames[video_path] = (mtime, frames, spill_path, created)
+            self.nbytes += frames.nbytes
+            self._evict()
+        return frames
+
+    def read(self, video_path, start=0, stop=None, step=1, rgb=True):
+        frames = self.get(video_path)[start:stop:step]
+        if not rgb:
+            return frames
+        out = np.empty(frames.shape, dtype=np.uint8)
+        for i in range(len(frames)):
+            cv2.cvtColor(frames[i], cv2.COLOR_BGR2RGB, dst=out[i])
+        return out
@@ -0,0 +1,112 @@
+import os
+import json
+import threading
+import numpy as np
+import torch
+from sam2.sam2_video_predictor import prepare_frames
+from tap_sam.vis_utils import extract_frames
+
+
+class InputStore:
+    """
+    SAM2 inputs of whole videos, resized to `image_size` and normalized, as fp16 .npy files.
+
+    `build` decodes a video once (BGR, the frames of the SAM path), resizes
+    the clip in batches with torch on `device` and writes the (T, 3, S, S)
+    fp16 tensor to `.<name>.sam<S>.npy` next to the video, or under
+    `store_dir` when given, with a json sidecar holding the original
+    height and width. `read` memory-maps the file, so init_state gets its
+    images without decoding or resizing. Like FrameCache, a file carries
+    the mtime of its video and is rebuilt when the video changes.
+    """
+
+    def __init__(self, image_size, store_dir=None, device="cpu", batch_size=32):
+        self.image_size = image_size
+        self.store_dir = store_dir
+        self.device = torch.device(device)
+        self.batch_size = batch_size
+        self.hits = 0
+        self.misses = 0
+        # guards the counters and _video_locks; builds only hold the lock of their video
+        self._lock = threading.Lock()
+        self._video_locks = {}
+
+    def get_path(self, video_path):
+        video_dir, video_name = os.path.split(os.path.abspath(video_path))
+        if self.store_dir is not None:
+            video_dir = self.store_dir
+            video_name = os.path.abspath(video_path).strip("/").replace("/", "_")
+        return os.path.join(video_dir, f".{video_name}.sam{self.image_size}.npy")
+
+    def is_valid(self, video_path):
+        path = self.get_path(video_path)
+        try:
+            return os.stat(path).st_mtime_ns == os.stat(video_path).st_mtime_ns and os.path.exists(path + ".json")
+        except FileNotFoundError:
+            return False
+
+    @torch.inference_mode()
+    def build(self, video_path, frames=None):
+        """Write the inputs of `video_path`, `frames` are its decoded BGR frames when already at hand."""
+        mtime = os.stat(video_path).st_mtime_ns
+        if frames is None:
+            frames = extract_frames(video_path)
+        path = self.get_path(video_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        shape = (len(frames), 3, self.image_size, self.image_size)
+        images = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float16, shape=shape)
+        try:
+            # one batch at a time, the whole clip in fp32 would not fit in memory
+            for start in range(0, len(frames), self.batch_size):
+                batch = prepare_frames(frames[start:start + self.batch_size], self.image_size, device=self.device)
+                images[start:start + len(batch)] = batch.half().cpu().numpy()
+            images.flush()
+            del images
+            with open(path + ".json", "w") as f:
+                json.dump({"height": int(frames.shape[1]), "width": int(frames.shape[2])}, f)
+            os.utime(tmp_path, ns=(mtime, mtime))
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return path
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+    def _get_video_lock(self, video_path):
+        with self._lock:
+            return self._video_locks.setdefault(os.path.abspath(video_path), threading.Lock())
+
+    def read(self, video_path, frame_indices=None):
+        """
+        (images, (height, width)) of `video_path`, images is a (T, 3, S, S) fp16 tensor
+        on the memory map, of the frames at `frame_indices` when given. The store
+        is built on first use.
+        """
+        # a miss builds under the lock of its video only, reads of stored videos go on
+        with self._get_video_lock(video_path):
+            hit = self.is_valid(video_path)
+            if not hit:
+                self.build(video_path)
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        path = self.get_path(video_path)
+        # copy-on-write mapping: torch wants writable arrays, the file is never modified
+        images = np.load(path, mmap_mode="c")
+        with open(path + ".json") as f:
+            meta = json.load(f)
+        if frame_indices is not None:
+            frame_indices = list(frame_indices)
+            first, last = frame_indices[0], frame_indices[-1]
+            if frame_indices == list(range(first, last + 1)):
+                # forward windows stay a view of the map
+                images = images[first:last + 1]
+            else:
+                images = images[frame_indices]
+        return torch.from_numpy(images), (meta["height"], meta["width"])
@@ -0,0 +1,262 @@
+import io
+import os
+import json
+import mmap
+import shutil
+import zlib
+import struct
+import numpy as np
+
+# container of SAM masks, (num_objects, num_frames, 1, H, W) bool:
+#   MAGIC, uint32 header length, json header (num_objects, height, width)
+#   one blob per (frame, object): zlib of the bit-packed mask inside its bounding box, empty for empty masks
+#   index: uint64 (offset, length) of the blobs (frame major) and int32 (num_frames, num_objects, 4) x0, y0, x1, y1 boxes
+#   json footer (num_frames, index and box offsets), uint32 footer length, END
+# update_masks rewrites a frame range in place: the new blobs go where the index
+# was, followed by a new index, the replaced blobs stay as unused bytes
+MAGIC = b"TSMASK1\0"
+END = b"TSMEND1\0"
+EXTENSION = ".masks"
+LENGTH = struct.Struct("<I")
+
+
+def encode_frame(masks):
+    # bool masks of one frame, 1 bit per pixel, zlib on top for the empty areas
+    return zlib.compress(np.packbits(np.asarray(masks, dtype=bool), axis=None).tobytes(), 1)
+
+
+def decode_frame(payload, shape):
+    bits = np.frombuffer(zlib.decompress(payload), dtype=np.uint8)
+    return np.unpackbits(bits, count=int(np.prod(shape))).reshape(shape).astype(bool)
+
+
+def get_bboxes(masks):
+    """(N, 4) x0, y0, x1, y1 (inclusive) boxes of (N, H, W) masks, -1 for empty masks."""
+    masks = np.asarray(masks, dtype=bool).reshape(len(masks), *np.shape(masks)[-2:])
+    rows, cols = masks.any(2), masks.any(1)
+    bboxes = np.full((len(masks), 4), -1, dtype=np.int32)
+    found = rows.any(1)
+    bboxes[found, 0] = cols[found].argmax(1)
+    bboxes[found, 1] = rows[found].argmax(1)
+    bboxes[found, 2] = cols.shape[1] - 1 - cols[found, ::-1].argmax(1)
+    bboxes[found, 3] = rows.shape[1] - 1 - rows[found, ::-1].argmax(1)
+    return bboxes
+
+
+def _write_blob(f, mask, bbox):
+    x0, y0, x1, y1 = bbox
+    blob = b"" if x0 < 0 else encode_frame(mask[y0:y1 + 1, x0:x1 + 1])
+    offset = f.tell()
+    f.write(blob)
+    return offset, len(blob)
+
+
+def _write_index(f, index, bboxes):
+    index_offset = f.tell()
+    index = np.asarray(index, dtype=np.uint64).reshape(-1, 2).tobytes()
+    footer = json.dumps({
+        "num_frames": len(bboxes),
+        "index_offset": index_offset,
+        "bbox_offset": index_offset + len(index),
+    }).encode()
+    f.write(index + bboxes.astype(np.int32).tobytes() + footer + LENGTH.pack(len(footer)) + END)
+
+
+class MaskWriter:
+    """
+    Writes masks frame by frame: `write_frame((num_objects, 1, H, W) masks)` for
+    every frame, then `close()`. `file` is a path or a seekable binary file object.
+    """
+
+    def __init__(self, file, num_objects, height, width):
+        self.own_file = isinstance(file, (str, os.PathLike))
+        if self.own_file:
+            os.makedirs(os.path.dirname(os.path.abspath(file)), exist_ok=True)
+            file = open(file, "wb")
+        self.file = file
+        self.num_objects, self.height, self.width = num_objects, height, width
+        header = json.dumps({"num_objects": num_objects, "height": height, "width": width}).encode()
+        self.file.write(MAGIC + LENGTH.pack(len(header)) + header)
+        self.index = []
+        self.bboxes = []
+
+    def write_frame(self, masks):
+        masks = np.asarray(masks, dtype=bool).reshape(self.num_objects, self.height, self.width)
+        bboxes = get_bboxes(masks)
+        for mask, bbox in zip(masks, bboxes):
+            self.index.append(_write_blob(self.file, mask, bbox))
+        self.bboxes.append(bboxes)
+
+    def close(self):
+        bboxes = np.stack(self.bboxes) if self.bboxes else np.zeros((0, self.num_objects, 4), np.int32)
+        _write_index(self.file, self.index, bboxes)
+        if self.own_file:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class MaskReader:
+    """
+    Random access to a mask file (path or bytes): `read_frame(t)` and `read(start, stop)`
+    decode only the requested frames, `bboxes` holds the boxes of all of them.
+    """
+
+    def __init__(self, source):
+        self._mmap = None
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            self.data = memoryview(source)
+        else:
+            # only the index and the requested blobs are paged in
+            with open(source, "rb") as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.data = memoryview(self._mmap)
+        data = self.data
+        if bytes(data[:len(MAGIC)]) != MAGIC or bytes(data[-len(END):]) != END:
+            raise ValueError("not a mask file")
+        (header_length,) = LENGTH.unpack_from(data, len(MAGIC))
+        header = json.loads(bytes(data[len(MAGIC) + LENGTH.size:len(MAGIC) + LENGTH.size + header_length]))
+        (footer_length,) = LENGTH.unpack_from(data, len(data) - len(END) - LENGTH.size)
+        footer_end = len(data) - len(END) - LENGTH.size
+        footer = json.loads(bytes(data[footer_end - footer_length:footer_end]))
+        self.num_objects, self.height, self.width = header["num_objects"], header["height"], header["width"]
+        self.num_frames = footer["num_frames"]
+        num_blobs = self.num_frames * self.num_objects
+        self.index_offset = footer["index_offset"]
+        self.index = np.frombuffer(data, dtype=np.uint64, count=num_blobs * 2, offset=self.index_offset).reshape(-1, 2)
+        self.bboxes = np.frombuffer(data, dtype=np.int32, count=num_blobs * 4, offset=footer["bbox_offset"]).reshape(
+            self.num_frames, self.num_objects, 4
+        )
+
+    @property
+    def shape(self):
+        return (self.num_objects, self.num_frames, 1, self.height, self.width)
+
+    def __len__(self):
+        return self.num_frames
+
+    def read_frame(self, frame_idx, out=None):
+        """(num_objects, 1, H, W) masks of one frame."""
+        if out is None:
+            out = np.zeros((self.num_objects, 1, self.height, self.width), dtype=bool)
+        for obj_idx, (x0, y0, x1, y1) in enumerate(self.bboxes[frame_idx]):
+            if x0 < 0:
+                continue
+            start, length = (int(x) for x in self.index[frame_idx * self.num_objects + obj_idx])
+            out[obj_idx, 0, y0:y1 + 1, x0:x1 + 1] = decode_frame(
+                self.data[start:start + length], (y1 - y0 + 1, x1 - x0 + 1)
+            )
+        return out
+
+    def close(self):
+        self.index = self.bboxes = None
+        try:
+            self.data.release()
+            if self._mmap is not None:
+                self._mmap.close()
+        except BufferError:
+            # arrays still pointing into the map, it is closed once they are gone
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def read(self, start=0, stop=None):
+        """(num_objects, stop - start, 1, H, W) masks of frames [start, stop)."""
+        frame_inds = range(*slice(start, stop).indices(self.num_frames))
+        masks = np.zeros((self.num_objects, len(frame_inds), 1, self.height, self.width), dtype=bool)
+        for i, frame_idx in enumerate(frame_inds):
+            self.read_frame(frame_idx, out=masks[:, i])
+        return masks
+
+
+def write_masks(file, masks):
+    masks = np.asarray(masks, dtype=bool)
+    num_objects, num_frames = masks.shape[:2]
+    with MaskWriter(file, num_objects, masks.shape[-2], masks.shape[-1]) as writer:
+        for frame_idx in range(num_frames):
+            writer.write_frame(masks[:, frame_idx])
+
+
+def encode_masks(masks):
+    f = io.BytesIO()
+    write_masks(f, masks)
+    return f.getvalue()
+
+
+def update_masks(path, masks, start=0, obj_idx=None):
+    """
+    Replace frames [start, start + T) of the mask file at `path` in place with the
+    (num_objects, T, 1, H, W) `masks`, or with (T, 1, H, W) masks of one object
+    when `obj_idx` is given. Only the new blobs and the index are written, the
+    other frames are not decoded. Not crash safe, update a copy (copy_masks).
+    """
+    with MaskReader(path) as reader:
+        num_objects, num_frames, height, width = reader.num_objects, reader.num_frames, reader.height, reader.width
+        index, bboxes, index_offset = reader.index.copy(), reader.bboxes.copy(), reader.index_offset
+    masks = np.asarray(masks, dtype=bool)
+    obj_inds = range(num_objects) if obj_idx is None else [obj_idx]
+    masks = masks.reshape(len(obj_inds), -1, height, width)
+    if start < 0 or start + masks.shape[1] > num_frames:
+        raise ValueError(f"frames {start}:{start + masks.shape[1]} are outside of the {num_frames} frames of {path}")
+    with open(path, "r+b") as f:
+        f.seek(index_offset)
+        for i in range(masks.shape[1]):
+            frame_idx = start + i
+            for mask, bbox, obj in zip(masks[:, i], get_bboxes(masks[:, i]), obj_inds):
+                index[frame_idx * num_objects + obj] = _write_blob(f, mask, bbox)
+                bboxes[frame_idx, obj] = bbox
+        _write_index(f, index, bboxes)
+        f.truncate()
+
+
+def copy_masks(src, dst):
+    """Copy the masks at `src` (or its legacy .npz) to `dst` for update_masks, without decoding them."""
+    path = find_masks(src)
+    if path is None:
+        raise FileNotFoundError(src)
+    os.makedirs(os.path.dirname(os.path.abspath(dst)), exist_ok=True)
+    with open(path, "rb") as f:
+        is_mask_file = f.read(len(MAGIC)) == MAGIC
+    if is_mask_file:
+        shutil.copyfile(path, dst)
+    else:
+        write_masks(dst, read_masks(path))
+
+
+def find_masks(path):
+    """`path`, or the legacy .npz next to it, whichever exists, else None."""
+    if os.path.exists(path):
+        return path
+    legacy_path = os.path.splitext(path)[0] + ".npz"
+    if os.path.exists(legacy_path):
+        return legacy_path
+    return None
+
+
+def read_masks(source):
+    """
+    All masks of a mask file (path or bytes) as a (num_objects, num_frames, 1, H, W)
+    bool array. Legacy np.save / np.savez(masks=...) files and paths whose
+    .npz sibling exists are read as well.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        path = find_masks(source)
+        if path is None:
+            raise FileNotFoundError(source)
+        with open(path, "rb") as f:
+            source = f.read()
+    if bytes(source[:len(MAGIC)]) == MAGIC:
+        with MaskReader(source) as reader:
+            return reader.read()
+    masks = np.load(io.BytesIO(source))
+    if isinstance(masks, np.lib.npyio.NpzFile):
+        masks = masks["masks"]
+    return masks.astype(bool)
@@ -0,0 +1,67 @@
+import json
+import struct
+from tap_sam.mask_io import encode_frame, decode_frame
+
+# record of a streamed SAM response: kind, frame index, payload length, then the payload
+RECORD = struct.Struct("<BII")
+HEADER, FRAME, ERROR = 0, 1, 2
+
+
+def encode_record(kind, payload, frame_idx=0):
+    return RECORD.pack(kind, frame_idx, len(payload)) + payload
+
+
+def encode_header(header):
+    return encode_record(HEADER, json.dumps(header).encode())
+
+
+def encode_error(message):
+    return encode_record(ERROR, json.dumps({"error": message}).encode())
+
+
+def _read_exact(read, size):
+    chunks = []
+    while size > 0:
+        chunk = read(size)
+        if not chunk:
+            raise EOFError("mask stream ended in the middle of a record")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def iter_records(read):
+    """(kind, frame_idx, payload) of the records of a stream, `read(n)` reads up to n bytes of it."""
+    while True:
+        head = read(RECORD.size)
+        if not head:
+            return
+        if len(head) < RECORD.size:
+            head += _read_exact(read, RECORD.size - len(head))
+        kind, frame_idx, size = RECORD.unpack(head)
+        yield kind, frame_idx, _read_exact(read, size)
+
+
+def iter_mask_stream(read):
+    """
+    Decode a streamed SAM response: returns the header (num_objects, num_frames,
+    height, width) and a generator of (frame_idx, (num_objects, 1, H, W) masks)
+    in the order the frames were tracked.
+    """
+    records = iter_records(read)
+    try:
+        kind, _, payload = next(records)
+    except StopIteration:
+        raise EOFError("empty mask stream") from None
+    if kind == ERROR:
+        raise RuntimeError(json.loads(payload)["error"])
+    header = json.loads(payload)
+    shape = (header["num_objects"], 1, header["height"], header["width"])
+
+    def frames():
+        for kind, frame_idx, payload in records:
+            if kind == ERROR:
+                raise RuntimeError(json.loads(payload)["error"])
+            yield frame_idx, decode_frame(payload, shape)
+
+    return header, frames()
@@ -0,0 +1,83 @@
+import cv2
+import numpy as np
+import matplotlib.pyplot as plt
+
+
+def get_colors(obj_ids):
+    """tab10 color (float RGB, applied as is to the BGR frames like before) of every object id."""
+    cmap = plt.get_cmap("tab10")
+    return np.array([cmap(int(obj_id))[:3] for obj_id in obj_ids])
+
+
+class MaskOverlay:
+    """
+    Draws the masks of all objects of a frame at once.
+
+    The masks are turned into one label map (later objects on top), and each
+    pixel is looked up in a uint8 table of `(1 - alpha) * pixel + alpha * color`
+    per object, so only the masked pixels of the frame are touched, in place.
+    The object numbers go at the mask centroids, from the moments of the
+    mask downscaled by `downscale`.
+    """
+
+    def __init__(self, colors, alpha=0.5, draw_labels=True, downscale=4):
+        colors = (np.asarray(colors, dtype=np.float64).reshape(-1, 3) * 255).astype(np.uint8)
+        values = np.arange(256, dtype=np.float64)
+        # lut[label, channel, value], label 0 is the background, kept flat for np.take
+        self.lut = np.empty((len(colors) + 1, 3, 256), dtype=np.uint8)
+        self.lut[0] = values.astype(np.uint8)
+        self.lut[1:] = ((1 - alpha) * values[None, None] + alpha * colors[:, :, None]).astype(np.uint8)
+        self.lut = self.lut.reshape(-1)
+        self.channel_offsets = np.arange(3, dtype=np.int32) * 256
+        self.draw_labels = draw_labels
+        self.downscale = downscale
+
+    def get_centroid(self, mask):
+        small = mask[::self.downscale, ::self.downscale]
+        scale = self.downscale
+        moments = cv2.moments(small.view(np.uint8), binaryImage=True)
+        if moments["m00"] == 0:
+            # too thin for the downscaled mask
+            scale = 1
+            moments = cv2.moments(mask.view(np.uint8), binaryImage=True)
+            if moments["m00"] == 0:
+                return None
+        return int(moments["m10"] / moments["m00"] * scale), int(moments["m01"] / moments["m00"] * scale)
+
+    def draw(self, frame, masks):
+        """Overlay the (N, 1, H, W) or (N, H, W) bool `masks` on the (H, W, 3) uint8 `frame` in place."""
+        height, width = frame.shape[:2]
+        masks = np.asarray(masks, dtype=bool).reshape(-1, height, width)
+        labels = np.zeros((height, width), dtype=np.uint8)
+        label = np.empty_like(labels)
+        for obj_idx, mask in enumerate(masks):
+            # the labels grow with obj_idx, so the max keeps the last object of each pixel
+            np.multiply(mask.view(np.uint8), obj_idx + 1, out=label)
+            np.maximum(labels, label, out=labels)
+        pixels = np.flatnonzero(labels)
+        flat = frame.reshape(-1, 3)
+        lut_index = labels.reshape(-1)[pixels, None].astype(np.int32) * 768 + self.channel_offsets
+        lut_index += flat[pixels]
+        flat[pixels] = np.take(self.lut, lut_index)
+        if self.draw_labels:
+            text_scale = width / 800
+            for obj_idx, mask in enumerate(masks):
+                centroid = self.get_centroid(mask)
+                if centroid is None:
+                    continue
+                x = min(max(centroid[0], 10), width - 10)
+                y = min(max(centroid[1], 10), height - 10)
+                cv2.putText(frame, str(obj_idx + 1), (x, y), cv2.FONT_HERSHEY_TRIPLEX, text_scale, (255, 255, 255), 1, cv2.LINE_AA)
+        return frame
+
+    def iter_video(self, video, masks):
+        """Overlaid copies of the frames of `video`, `masks` is (N, T, 1, H, W)."""
+        for frame_idx, frame in enumerate(video):
+            yield self.draw(np.array(frame), masks[:, frame_idx])
+
+
+def render_masks(video, masks, colors, alpha=0.5, draw_labels=True):
+    """List of the (T, H, W, 3) `video` frames with the (N, T, 1, H, W) `masks` drawn on copies."""
+    masks = np.asarray(masks)
+    assert len(video) == masks.shape[1], f"video shape: {len(video)}, mask shape: {masks.shape[1]}"
+    return list(MaskOverlay(colors, alpha, draw_labels).iter_video(video, masks))
@@ -1,8 +1,12 @@
 import cv2
+import contextlib
 import torch
 import numpy as np
-import matplotlib.pyplot as plt
 from sam2.build_sam import build_sam2_video_predictor
+from tap_sam.overlay import MaskOverlay, get_colors
+
+# autocast dtype of each precision profile, fp32 runs without autocast
+PRECISIONS = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}
 
 
 class Sam:
@@ -13,14 +17,75 @@ class Sam:
         threshold=0.0,
         save_visualization=False,
         device="cpu",
+        feature_cache=None,
+        image_feature_cache_size=64,
+        image_feature_cache_device=None,
+        prefetch_batch_size=0,
+        precision="fp32",
+        compile=False,
+        channels_last=False,
+        num_threads=None,
+        offload_video_to_cpu=False,
+        offload_state_to_cpu=False,
+        quantize_int8=False,
+        cpu_model_cfg=None,
+        cpu_checkpoint=None,
     ):
+        # gpu-less servers run on the cpu instead of failing, with the smaller
+        # cpu backbone (cpu_model_cfg / cpu_checkpoint) when one is configured
+        if str(device).startswith("cuda") and not torch.cuda.is_available():
+            print("cuda is not available, running SAM on the cpu")
+            device = "cpu"
+        if device == "cpu" and cpu_model_cfg is not None:
+            model_cfg, sam2_checkpoint = cpu_model_cfg, cpu_checkpoint
+        if num_threads is not None:
+            # process wide, one worker per cpu socket works best
+            torch.set_num_threads(num_threads)
+        self.device = device
+        self.offload_video_to_cpu = offload_video_to_cpu
+        self.offload_state_to_cpu = offload_state_to_cpu
         self.sam2_checkpoint = sam2_checkpoint
+        # optional FeatureCache, keeps frame features of a video across set_video_list calls
+        self.feature_cache = feature_cache
         self.model_cfg = model_cfg
         self.threshold = threshold
         self.save_visualization = save_visualization
+        # per-request cache of the frames' backbone features, None (gpu), "cpu" or "disk"
+        hydra_overrides_extra = [
+            f"++model.image_feature_cache_size={image_feature_cache_size}",
+            f"++model.image_feature_cache_device={image_feature_cache_device or 'null'}",
+            # frames encoded in one batch ahead of propagation, 0 encodes them one by one
+            f"++model.prefetch_batch_size={prefetch_batch_size}",
+        ]
         self.predictor = build_sam2_video_predictor(
-            self.model_cfg, self.sam2_checkpoint, device
+            self.model_cfg, self.sam2_checkpoint, device, hydra_overrides_extra=hydra_overrides_extra
         )
+        # performance profile, tools/check_sam_profile.py compares its masks with fp32
+        if precision not in PRECISIONS:
+            raise ValueError(f"precision must be one of {list(PRECISIONS)}, got {precision}")
+        self.precision = precision
+        if channels_last:
+            self.predictor.image_encoder.to(memory_format=torch.channels_last)
+        if compile:
+            # frame batches have a fixed shape, the memory grows with the tracked frames
+            self.predictor.image_encoder.forward = torch.compile(self.predictor.image_encoder.forward, dynamic=False)
+            self.predictor.memory_attention.forward = torch.compile(self.predictor.memory_attention.forward, dynamic=True)
+        if quantize_int8:
+            if device != "cpu":
+                raise ValueError("quantize_int8 only runs on the cpu")
+            # int8 weights of the linear layers (most of the hiera blocks and the
+            # memory attention), activations are quantized on the fly
+            for name in ["image_encoder", "memory_attention"]:
+                module = torch.ao.quantization.quantize_dynamic(
+                    getattr(self.predictor, name), {torch.nn.Linear}, dtype=torch.qint8
+                )
+                setattr(self.predictor, name, module)
+
+    def autocast(self):
+        dtype = PRECISIONS[self.precision]
+        if dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(self.predictor.device.type, dtype=dtype)
 
     def get_mask_on_image(
         self, masks_list, video, obj_id=None, random_color=False, save_path=None
@@ -33,63 +98,65 @@ class Sam:
             color = np.concatenate([np.random.random(3)], axis=0)
             colors = [color for _ in range(len(masks_list))]
         else:
-            cmap = plt.get_cmap("tab10")
-            colors = [np.array([*cmap(int(i))[:3]]) for i in obj_id]
-
-        mask_image = [torch.tensor(masks_list[i]).permute(2, 3, 1, 0).numpy() * (
-            colors[i].reshape(1, 1, -1)[:, :, :, None]
-        ) for i in range(len(masks_list))]
-        
-        mask_image = [
-            (torch.tensor(mask_image[i]).permute(3, 0, 1, 2) * 255)
-            .numpy()
-            .astype(np.uint8) for i in range(len(mask_image))
-        ]
-        mix_image_list = []
+            colors = get_colors(range(len(masks_list)) if obj_id is None else obj_id)
 
-        # add mask to video
-        width, height = mask_image[0][0].shape[1], mask_image[0][0].shape[0]
+        overlay = MaskOverlay(colors, alpha=1.0)
+        masks_list = np.asarray(masks_list)
+        assert video.shape[0] == masks_list.shape[1], f"video shape: {video.shape[0]}, mask shape: {masks_list.shape[1]}"
+        height, width = video.shape[1:3]
         if self.save_visualization:
             result = cv2.VideoWriter(
                 save_path, cv2.VideoWriter_fourcc(*"MJPG"), 10, (width, height)
             )
-            
-        text_scale = width / 800
-        assert video.shape[0] == mask_image[0].shape[0], f"video shape: {video.shape[0]}, mask shape: {mask_image[0].shape[0]}"
-        for i in range(video.shape[0]):      
-            for obj_id in range(len(masks_list)):
-                mix_mask = masks_list[obj_id][i][0][:, :, None].repeat(3, axis=2)
-                mix_image = np.where(mix_mask, mask_image[obj_id][i], video[i]) if obj_id == 0 else np.where(mix_mask, mask_image[obj_id][i], mix_image)
-                # write number on the mask in the image by cv2
-                loc = np.where(mix_mask[:,:,0])
-                if len(loc[0]) == 0:
-                    continue
-                loc = (np.mean(loc[0]).astype(int), np.mean(loc[1]).astype(int))
-                
-                if loc[0] < 10:
-                    loc = (10, loc[1])
-                if loc[1] < 10:
-                    loc = (loc[0], 10)
-                if loc[0] > height - 10:
-                    loc = (height - 10, loc[1])
-                if loc[1] > width - 10:
-                    loc = (loc[0], width - 10)
-                
-                cv2.putText(mix_image, str(obj_id+1), (loc[1], loc[0]), cv2.FONT_HERSHEY_TRIPLEX, text_scale, (255, 255, 255), 1, cv2.LINE_AA)
-            
+
+        mix_image_list = []
+        for mix_image in overlay.iter_video(video, masks_list):
             mix_image_list.append(mix_image)
             if self.save_visualization:
                 result.write(mix_image)
-                result.release()
+        if self.save_visualization:
+            result.release()
 
         return mix_image_list
 
-    def set_video_list(self, video_list, video_path):
+    def cache_stats(self):
+        """Hit / miss counters of the shared feature cache and of the per-state cache of the last video."""
+        stats = {}
+        if self.feature_cache is not None:
+            stats["feature_cache"] = self.feature_cache.stats()
+        inference_state = getattr(self, "inference_state", None)
+        if inference_state is not None:
+            stats["image_feature_cache"] = inference_state["cached_features"].stats()
+        return stats
+
+    def set_video_list(self, video_list, video_path, frame_indices=None, images=None, video_size=None):
+        # images / video_size: preprocessed inputs of the frames from an InputStore
         self.video_list = video_list
-        self.inference_state = self.predictor.init_state(video_list, video_path)
+        with self.autocast():
+            self.inference_state = self.predictor.init_state(
+                video_list,
+                video_path,
+                offload_video_to_cpu=self.offload_video_to_cpu,
+                offload_state_to_cpu=self.offload_state_to_cpu,
+                feature_cache=self.feature_cache,
+                frame_indices=frame_indices,
+                images=images,
+                video_size=video_size,
+            )
     
-    def __call__(self, object_points, labels, select_frame, ann_obj_ids):
-        masks = []
+    def __call__(self, object_points, labels, select_frame, ann_obj_ids, bidirectional=False, on_frame=None):
+        """
+        Track the prompted objects from `select_frame` to the end of the video, with
+        `bidirectional` also back to the first frame on the same inference state, so
+        features and memory of both directions are shared.
+        `on_frame(frame_idx, masks)` is called with the (num_objects, 1, H, W) masks
+        of every frame as soon as it is tracked.
+        """
+        with self.autocast():
+            video_segments = self._propagate(object_points, labels, select_frame, ann_obj_ids, bidirectional, on_frame)
+        return np.stack([video_segments[frame_idx] for frame_idx in sorted(video_segments.keys())], axis=1)
+
+    def _propagate(self, object_points, labels, select_frame, ann_obj_ids, bidirectional, on_frame=None):
         # inference_state = self.predictor.init_state(video_path)
         self.predictor.reset_state(self.inference_state)
         
@@ -101,26 +168,17 @@ class Sam:
                 points=object_points[i],
                 labels=labels[i],
             )
-        video_segments = (
-            {}
-        )  # video_segments contains the per-frame segmentation results
-        for (
-            out_frame_idx,
-            out_obj_ids,
-            out_mask_logits,
-        ) in self.predictor.propagate_in_video(self.inference_state):
-            video_segments[out_frame_idx] = {
-                out_obj_id: (out_mask_logits[i] > 0.0)
-                for i, out_obj_id in enumerate(out_obj_ids)
-            }
-        
-        masks = []
-        for i in range(len(object_points)):
-            masks.append(
-                np.array([
-                    video_segments[frame_idx][int(ann_obj_ids[i])].cpu().numpy()
-                    for frame_idx in sorted(video_segments.keys())
-                ])
-            )
-        mask = np.stack(masks, axis=0)
-        return mask
+        obj_ids = self.inference_state["obj_ids"]
+        obj_index = [obj_ids.index(int(obj_id)) for obj_id in ann_obj_ids]
+        # all objects are propagated together, each frame is copied to the cpu once for all of them
+        video_segments = {}
+        for reverse in ([False, True] if bidirectional else [False]):
+            for (
+                out_frame_idx,
+                out_obj_ids,
+                out_mask_logits,
+            ) in self.predictor.propagate_in_video(self.inference_state, reverse=reverse):
+                video_segments[out_frame_idx] = (out_mask_logits > 0.0).cpu().numpy()[obj_index]
+                if on_frame is not None:
+                    on_frame(out_frame_idx, video_segments[out_frame_idx])
+        return video_segments
@@ -0,0 +1,208 @@
+import time
+import queue
+import threading
+import torch
+from concurrent.futures import Future, CancelledError, InvalidStateError
+
+
+class SamJob:
+    def __init__(
+        self,
+        key,
+        video,
+        video_path,
+        objects,
+        frame_indices=None,
+        select_frame=0,
+        bidirectional=False,
+        images=None,
+        video_size=None,
+        frame_queue=None,
+    ):
+        # jobs with the same key run on the same frames and share one inference state
+        self.key = key
+        self.video = video
+        self.video_path = video_path
+        self.frame_indices = frame_indices
+        self.select_frame = select_frame
+        self.bidirectional = bidirectional
+        # preprocessed SAM inputs of the frames (InputStore), used instead of video when given
+        self.images = images
+        self.video_size = video_size
+        # optional queue.Queue receiving (frame_idx, masks) per tracked frame, then None
+        self.frame_queue = frame_queue
+        # set when the consumer of frame_queue stopped taking frames, the job then fails
+        self.stalled = False
+        # list of (points, labels), one entry per object
+        self.objects = objects
+        # future.cancel() drops the job, also while its pass is running
+        self.future = Future()
+
+    @property
+    def cancelled(self):
+        return self.future.cancelled()
+
+    @property
+    def dropped(self):
+        return self.cancelled or self.stalled
+
+    def set_result(self, result):
+        try:
+            self.future.set_result(result)
+        except InvalidStateError:
+            # cancelled meanwhile
+            pass
+
+    def set_exception(self, exception):
+        try:
+            self.future.set_exception(exception)
+        except InvalidStateError:
+            pass
+
+
+class SamScheduler:
+    """
+    Runs all SAM requests of a worker on one GPU thread.
+
+    A job waits at most `max_wait` seconds for other jobs; queued jobs on the
+    same frame window of the same video are then registered as objects of one
+    inference state and propagated in a single pass (up to `max_objects`
+    objects per pass). Jobs on other windows run in the next passes, in
+    arrival order. Cancelled jobs are skipped, and a pass stops once all of
+    its jobs are cancelled. A frame queue that stays full for `stream_timeout`
+    seconds fails its job with a TimeoutError, so a client that stops reading
+    holds up the other jobs of the worker at most that long.
+    """
+
+    def __init__(self, model_sam, max_wait=0.02, max_objects=32, stream_timeout=30.0):
+        self.model_sam = model_sam
+        self.max_wait = max_wait
+        self.max_objects = max_objects
+        self.stream_timeout = stream_timeout
+        self.queue = queue.Queue()
+        self.num_jobs = 0
+        self.num_batches = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(
+        self,
+        video,
+        video_path,
+        window,
+        objects,
+        frame_indices=None,
+        select_frame=0,
+        bidirectional=False,
+        images=None,
+        video_size=None,
+        frame_queue=None,
+    ):
+        """
+        Queue `objects` on `video` (the frames of `window` of `video_path`, prompts on
+        `select_frame`, `frame_indices` their index in the full video), tracked forward
+        or with `bidirectional` in both directions. `images` and `video_size` are the
+        preprocessed inputs of the frames, see tap_sam/input_store.py. With `frame_queue`
+        the masks of each frame are put on it as (frame_idx, (len(objects), 1, H, W))
+        while the pass runs, followed by None once the future is done; a bounded
+        queue holds the pass back until the consumer takes the frames.
+        Returns a Future of the (len(objects), T, 1, H, W) masks, cancel it when
+        the result is not needed any more.
+        """
+        key = (video_path, window, video.shape, select_frame, bidirectional)
+        job = SamJob(
+            key, video, video_path, objects, frame_indices, select_frame, bidirectional, images, video_size, frame_queue
+        )
+        self.queue.put(job)
+        return job.future
+
+    def _collect(self, pending):
+        if len(pending) == 0:
+            pending.append(self.queue.get())
+            deadline = time.time() + self.max_wait
+        else:
+            deadline = time.time()
+        while True:
+            try:
+                pending.append(self.queue.get(timeout=max(deadline - time.time(), 0)))
+            except queue.Empty:
+                return pending
+
+    def _next_batch(self, pending):
+        key = pending[0].key
+        batch, rest, num_objects = [], [], 0
+        for job in pending:
+            if job.key == key and (len(batch) == 0 or num_objects + len(job.objects) <= self.max_objects):
+                batch.append(job)
+                num_objects += len(job.objects)
+            else:
+                rest.append(job)
+        return batch, rest
+
+    def _run(self):
+        # the current cuda device is per thread, set_device in the loading thread does not reach this one
+        device = torch.device(self.model_sam.device)
+        if device.type == "cuda":
+            torch.cuda.set_device(device)
+        pending = []
+        while True:
+            pending = self._collect(pending)
+            batch, pending = self._next_batch(pending)
+            self._run_batch(batch)
+
+    def _put_frame(self, job, item):
+        # wait for room in a bounded queue, unless the consumer gave up or stalled
+        deadline = time.time() + self.stream_timeout
+        while not job.dropped:
+            try:
+                job.frame_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                if time.time() > deadline:
+                    job.stalled = True
+                    job.set_exception(TimeoutError(f"frames not taken for {self.stream_timeout}s"))
+
+    def _on_frame(self, batch, frame_idx, masks):
+        start = 0
+        for job in batch:
+            if job.frame_queue is not None:
+                self._put_frame(job, (frame_idx, masks[start:start + len(job.objects)]))
+            start += len(job.objects)
+        if all(job.dropped for job in batch):
+            raise CancelledError()
+
+    def _finish(self, batch):
+        for job in batch:
+            if job.frame_queue is not None:
+                self._put_frame(job, None)
+
+    def _run_batch(self, batch):
+        batch = [job for job in batch if not job.cancelled]
+        if len(batch) == 0:
+            return
+        points, labels = [], []
+        for job in batch:
+            for object_points, object_labels in job.objects:
+                points.append(object_points)
+                labels.append(object_labels)
+        try:
+            # object ids are only used inside the batch, requests may reuse the same ids
+            job = batch[0]
+            self.model_sam.set_video_list(job.video, job.video_path, job.frame_indices, job.images, job.video_size)
+            # also without frame queues, so a cancelled pass stops at the next frame
+            on_frame = lambda frame_idx, masks: self._on_frame(batch, frame_idx, masks)
+            masks = self.model_sam(
+                points, labels, job.select_frame, list(range(len(points))), job.bidirectional, on_frame
+            )
+        except Exception as e:
+            for job in batch:
+                job.set_exception(e)
+            self._finish(batch)
+            return
+        self.num_jobs += len(batch)
+        self.num_batches += 1
+        start = 0
+        for job in batch:
+            job.set_result(masks[start:start + len(job.objects)])
+            start += len(job.objects)
+        self._finish(batch)
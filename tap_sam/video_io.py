@@ -0,0 +1,308 @@
+import io
+import os
+import queue
+import tempfile
+import threading
+import cv2
+import numpy as np
+
+try:
+    import av
+except ImportError:
+    av = None
+
+
+def get_video_info(source):
+    """(num_frames, height, width, fps) from the container metadata, num_frames may be approximate."""
+    video = cv2.VideoCapture(source)
+    try:
+        num_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+        height = int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        width = int(video.get(cv2.CAP_PROP_FRAME_WIDTH))
+        fps = video.get(cv2.CAP_PROP_FPS)
+    finally:
+        video.release()
+    return num_frames, height, width, fps
+
+
+def _frame_range(num_frames, start, stop, step):
+    return range(*slice(start, stop, step).indices(max(num_frames, 0)))
+
+
+def _grow(frames, num_frames):
+    # the metadata frame count was too small, rare but happens with broken containers
+    grown = np.empty((max(num_frames, 2 * len(frames)),) + frames.shape[1:], dtype=np.uint8)
+    grown[:len(frames)] = frames
+    return grown
+
+
+def _read_cv2(path, start, stop, step, rgb):
+    num_frames, height, width, _ = get_video_info(path)
+    indices = _frame_range(num_frames, start, stop, step)
+    frames = np.empty((len(indices), height, width, 3), dtype=np.uint8)
+    video = cv2.VideoCapture(path)
+    n, frame_idx = 0, 0
+    try:
+        # jump to the keyframe before start instead of decoding everything before it
+        if start > 0 and video.set(cv2.CAP_PROP_POS_FRAMES, start):
+            frame_idx = int(video.get(cv2.CAP_PROP_POS_FRAMES))
+            if frame_idx > start:
+                video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                frame_idx = 0
+        while stop is None or frame_idx < stop:
+            if frame_idx < start or (frame_idx - start) % step != 0:
+                # grab skips the color conversion of frames we do not keep
+                if not video.grab():
+                    break
+                frame_idx += 1
+                continue
+            if n >= len(frames):
+                frames = _grow(frames, n + 1)
+            # decode straight into the preallocated output
+            success, _ = video.read(frames[n])
+            if not success:
+                break
+            if rgb:
+                cv2.cvtColor(frames[n], cv2.COLOR_BGR2RGB, dst=frames[n])
+            n += 1
+            frame_idx += 1
+    finally:
+        video.release()
+    return frames[:n]
+
+
+def _read_av(source, start, stop, step, rgb, threads):
+    container = av.open(source)
+    try:
+        stream = container.streams.video[0]
+        stream.thread_type = "AUTO"
+        if threads > 0:
+            stream.thread_count = threads
+        indices = _frame_range(stream.frames, start, stop, step)
+        frames = np.empty((len(indices), stream.height, stream.width, 3), dtype=np.uint8)
+        rate, time_base = stream.average_rate, stream.time_base
+        start_time = stream.start_time or 0
+        # seek to the keyframe before start, frame indices then come from the timestamps
+        seek = start > 0 and rate is not None and time_base is not None
+        if seek:
+            container.seek(int(start / rate / time_base) + start_time, stream=stream, backward=True)
+        n = 0
+        for frame_idx, frame in enumerate(container.decode(stream)):
+            if seek:
+                if frame.pts is None:
+                    raise RuntimeError("frame without timestamp after seek")
+                frame_idx = int(round((frame.pts - start_time) * time_base * rate))
+            if stop is not None and frame_idx >= stop:
+                break
+            if frame_idx < start or (frame_idx - start) % step != 0:
+                continue
+            if n >= len(frames):
+                frames = _grow(frames, n + 1)
+            frames[n] = frame.to_ndarray(format="rgb24" if rgb else "bgr24")
+            n += 1
+    finally:
+        container.close()
+    return frames[:n]
+
+
+def read_video(source, start=0, stop=None, step=1, rgb=True, backend=None, threads=0):
+    """
+    Decode frames [start:stop:step] of a video into one (T, H, W, 3) uint8 array.
+    Decoding starts at the keyframe before `start` and ends at `stop`, so a short
+    range costs about one GOP plus the requested frames.
+
+    `source` is a path or the bytes of an mp4. The output is allocated once from
+    the container metadata and the frames are decoded into it, no per-frame list.
+    `backend` is "cv2" or "av" (PyAV, decodes with `threads` ffmpeg threads, 0 = auto);
+    by default PyAV is used when installed. `rgb=False` returns BGR like cv2.
+    """
+    if backend is None:
+        backend = "av" if av is not None else "cv2"
+    if backend == "av":
+        if isinstance(source, (bytes, bytearray)):
+            source = io.BytesIO(source)
+        return _read_av(source, start, stop, step, rgb, threads)
+    if isinstance(source, (bytes, bytearray)):
+        # cv2 only opens files
+        with tempfile.NamedTemporaryFile(suffix=".mp4") as f:
+            f.write(source)
+            f.flush()
+            return _read_cv2(f.name, start, stop, step, rgb)
+    if not os.path.exists(source):
+        raise FileNotFoundError(source)
+    return _read_cv2(source, start, stop, step, rgb)
+
+
+def _iter_cv2(path, start, stop, rgb):
+    video = cv2.VideoCapture(path)
+    frame_idx = 0
+    try:
+        if start > 0 and video.set(cv2.CAP_PROP_POS_FRAMES, start):
+            frame_idx = int(video.get(cv2.CAP_PROP_POS_FRAMES))
+            if frame_idx > start:
+                video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                frame_idx = 0
+        while stop is None or frame_idx < stop:
+            if frame_idx < start:
+                if not video.grab():
+                    break
+                frame_idx += 1
+                continue
+            success, frame = video.read()
+            if not success:
+                break
+            if rgb:
+                cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=frame)
+            yield frame
+            frame_idx += 1
+    finally:
+        video.release()
+
+
+def _iter_av(source, start, stop, rgb, threads):
+    container = av.open(source)
+    try:
+        stream = container.streams.video[0]
+        stream.thread_type = "AUTO"
+        if threads > 0:
+            stream.thread_count = threads
+        rate, time_base = stream.average_rate, stream.time_base
+        start_time = stream.start_time or 0
+        seek = start > 0 and rate is not None and time_base is not None
+        if seek:
+            container.seek(int(start / rate / time_base) + start_time, stream=stream, backward=True)
+        for frame_idx, frame in enumerate(container.decode(stream)):
+            if seek:
+                if frame.pts is None:
+                    raise RuntimeError("frame without timestamp after seek")
+                frame_idx = int(round((frame.pts - start_time) * time_base * rate))
+            if stop is not None and frame_idx >= stop:
+                break
+            if frame_idx < start:
+                continue
+            yield frame.to_ndarray(format="rgb24" if rgb else "bgr24")
+    finally:
+        container.close()
+
+
+class _Done:
+    # end of a queue of _run_ahead, carries the error of the producer if any
+    def __init__(self, error=None):
+        self.error = error
+
+
+def _run_ahead(frames, size):
+    # runs the generator `frames` in a thread, at most `size` items ahead of the consumer
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in frames:
+                while not stop.is_set():
+                    try:
+                        items.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    break
+        except Exception as e:
+            items.put(_Done(e))
+            return
+        finally:
+            frames.close()
+        items.put(_Done())
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if isinstance(item, _Done):
+                if item.error is not None:
+                    raise item.error
+                return
+            yield item
+    finally:
+        # the consumer stopped early, let the producer finish and release the video
+        stop.set()
+        while thread.is_alive():
+            try:
+                items.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        thread.join()
+
+
+def iter_video(source, start=0, stop=None, rgb=True, backend=None, threads=0, prefetch=0):
+    """
+    Frames [start:stop] of a video one at a time, a new (H, W, 3) uint8 array each,
+    for passes that need no random access, so memory does not grow with the video.
+    With `prefetch` > 0 the frames are decoded in a thread, at most `prefetch` of
+    them ahead of the consumer. `source`, `backend` and `threads` as in read_video.
+    """
+    if backend is None:
+        backend = "av" if av is not None else "cv2"
+    if backend == "av":
+        if isinstance(source, (bytes, bytearray)):
+            source = io.BytesIO(source)
+        frames = _iter_av(source, start, stop, rgb, threads)
+    else:
+        if isinstance(source, (bytes, bytearray)):
+            raise ValueError("iter_video reads bytes with PyAV only")
+        if not os.path.exists(source):
+            raise FileNotFoundError(source)
+        frames = _iter_cv2(source, start, stop, rgb)
+    if prefetch > 0:
+        return _run_ahead(frames, prefetch)
+    return frames
+
+
+def write_video(path, frames, fps, fourcc="XVID", queue_size=16):
+    """
+    Encode the BGR `frames` (any iterable, consumed as it goes) to `path` with
+    cv2.VideoWriter. Encoding runs in a thread behind a queue of `queue_size`
+    frames, so producing the next frames overlaps with it and at most that many
+    frames are held. The frames must not be changed once yielded. Returns the
+    number of frames written.
+    """
+    pending = queue.Queue(maxsize=queue_size)
+    errors = []
+
+    def encode():
+        writer = None
+        try:
+            while True:
+                frame = pending.get()
+                if frame is None:
+                    return
+                if writer is None:
+                    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*fourcc), fps, (frame.shape[1], frame.shape[0]))
+                    if not writer.isOpened():
+                        raise IOError(f"can not open {path} for writing")
+                writer.write(frame)
+        except Exception as e:
+            errors.append(e)
+            # keep taking frames so the producer never blocks
+            while pending.get() is not None:
+                pass
+        finally:
+            if writer is not None:
+                writer.release()
+
+    thread = threading.Thread(target=encode, daemon=True)
+    thread.start()
+    num_frames = 0
+    try:
+        for frame in frames:
+            if errors:
+                break
+            pending.put(frame)
+            num_frames += 1
+    finally:
+        pending.put(None)
+        thread.join()
+    if errors:
+        raise errors[0]
+    return num_frames
@@ -8,6 +8,8 @@ from matplotlib import cm
 import torch.nn.functional as F
 from PIL import Image, ImageDraw
 from tapnet.utils import viz_utils
+from tap_sam import frame_cache
+from tap_sam.video_io import read_video
 
 def get_points(select_frame, video, mode='TAP'):
     colormap = viz_utils.get_colors(20)
@@ -50,21 +52,31 @@ def get_points(select_frame, video, mode='TAP'):
     print('Negative points:', negative_points)
     return np.array(select_points), np.array(negative_points), np.array(labels)
 
-def extract_frames(video_path):
-    # Open the video file
-    video = cv2.VideoCapture(video_path)
-    frames = []
-    success, frame = video.read()
-    # Iterate over each frame in the video
-    while success:
-        # Append the current frame to the list
-        frames.append(frame)
-        # Read the next frame
-        success, frame = video.read()
-
-    # Release the video capture object
-    video.release()
-    return np.array(frames)
+def extract_frames(video_path, start=0, stop=None, step=1):
+    # BGR frames like cv2, decoded into one preallocated array
+    if frame_cache.FRAME_CACHE is not None:
+        return frame_cache.FRAME_CACHE.read(video_path, start, stop, step, rgb=False)
+    return read_video(video_path, start, stop, step, rgb=False)
+
+def extract_sam_frames(video_path, select_frame, is_video, direction):
+    """
+    Decode only the frames a SAM request tracks: the prompt frame, the tail from it
+    (forward), the head up to it reversed (backward) or the full video (bidirection).
+    Returns the frames and their indices in the full video.
+    """
+    if not is_video:
+        video = extract_frames(video_path, select_frame, select_frame + 1)
+        frame_indices = [select_frame]
+    elif direction == "forward":
+        video = extract_frames(video_path, select_frame)
+        frame_indices = list(range(select_frame, select_frame + len(video)))
+    elif direction == "backward":
+        video = extract_frames(video_path, 0, select_frame + 1)[::-1]
+        frame_indices = list(range(len(video)))[::-1]
+    else:
+        video = extract_frames(video_path)
+        frame_indices = list(range(len(video)))
+    return video, frame_indices
 
 def save_multi_frames(image_list, save_path):
     if not os.path.exists(save_path):
@@ -74,14 +86,12 @@ def save_multi_frames(image_list, save_path):
 
 def read_video_from_path(path):
     try:
-        reader = imageio.get_reader(path)
+        if frame_cache.FRAME_CACHE is not None:
+            return frame_cache.FRAME_CACHE.read(path)
+        return read_video(path, rgb=True)
     except Exception as e:
         print("Error opening video file: ", e)
         return None
-    frames = []
-    for i, im in enumerate(reader):
-        frames.append(np.array(im))
-    return np.stack(frames)
 
 def draw_circle(rgb, coord, radius, color=(255, 0, 0), visible=True):
     # Create a draw object
@@ -0,0 +1,240 @@
+import os
+import time
+import sqlite3
+import threading
+
+TODO, CLAIMED = 0, 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    mode TEXT NOT NULL,
+    video_path TEXT NOT NULL,
+    video_name TEXT NOT NULL,
+    anno_path TEXT NOT NULL DEFAULT '',
+    save_path TEXT NOT NULL DEFAULT '',
+    is_human INTEGER NOT NULL DEFAULT 0,
+    state INTEGER NOT NULL DEFAULT 0,
+    seq INTEGER NOT NULL,
+    updated REAL NOT NULL,
+    UNIQUE (mode, video_path)
+);
+CREATE INDEX IF NOT EXISTS tasks_queue ON tasks (mode, state, is_human, seq);
+CREATE INDEX IF NOT EXISTS tasks_name ON tasks (mode, video_name, state, seq);
+CREATE INDEX IF NOT EXISTS tasks_seq ON tasks (seq);
+CREATE TABLE IF NOT EXISTS user_videos (
+    mode TEXT NOT NULL,
+    user_name TEXT NOT NULL,
+    round INTEGER NOT NULL,
+    video_name TEXT NOT NULL,
+    PRIMARY KEY (mode, user_name, round, video_name)
+);
+CREATE INDEX IF NOT EXISTS user_videos_name ON user_videos (mode, user_name, video_name);
+"""
+
+
+def get_video_name(video_path):
+    return video_path.split('/')[-1].strip()
+
+
+class TaskStore:
+    """
+    Annotation work queue shared by all server processes.
+
+    Every video is one row in an sqlite database (WAL mode) with state TODO
+    (the old no_annotation_*.json) or CLAIMED (the old has_annotation_*.json).
+    All lookups go through an index, and every state transition is a single
+    transaction, so claim/release cost O(log n) and never rewrite the queue.
+    The queue order is kept in `seq`: releasing a video puts it at the end,
+    exactly like re-inserting a key into the json dict did.
+    The user_videos table mirrors the re-annotation rounds of every user, so
+    a user's round is counted and claimed with a join instead of name lists.
+    """
+
+    def __init__(self, db_path, timeout=30.0):
+        self.db_path = db_path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        # sqlite connections must not cross threads or forked processes
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        conn = sqlite3.connect(self.db_path, timeout=self.timeout, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(SCHEMA)
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def _transaction(self):
+        return _Transaction(self._connect())
+
+    @staticmethod
+    def _row_to_task(row):
+        if row is None:
+            return None
+        return {
+            'video_path': row['video_path'],
+            'anno_path': row['anno_path'],
+            'save_path': row['save_path'],
+            'state': row['state'],
+        }
+
+    @staticmethod
+    def _next_seq(conn):
+        seq = conn.execute('SELECT MAX(seq) FROM tasks').fetchone()[0]
+        return 0 if seq is None else seq + 1
+
+    def add(self, mode, video_path, anno_path='', save_path='', state=TODO):
+        self.add_many(mode, [(video_path, {'anno_path': anno_path, 'save_path': save_path})], state)
+
+    def add_many(self, mode, tasks, state=TODO):
+        """Insert or overwrite (video_path, info) pairs, appending new ones to the queue."""
+        with self._transaction() as conn:
+            seq = self._next_seq(conn)
+            for video_path, info in tasks:
+                conn.execute(
+                    'INSERT INTO tasks (mode, video_path, video_name, anno_path, save_path, is_human, state, seq, updated) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT (mode, video_path) DO UPDATE SET '
+                    'anno_path = excluded.anno_path, save_path = excluded.save_path, state = excluded.state, updated = excluded.updated',
+                    (mode, video_path, get_video_name(video_path), info.get('anno_path', ''), info.get('save_path', ''),
+                     int('ann_human' in video_path), state, seq, time.time()),
+                )
+                seq += 1
+
+    def get(self, mode, video_path):
+        row = self._connect().execute(
+            'SELECT * FROM tasks WHERE mode = ? AND video_path = ?', (mode, video_path)
+        ).fetchone()
+        return self._row_to_task(row)
+
+    def has_todo(self, mode):
+        row = self._connect().execute(
+            'SELECT 1 FROM tasks WHERE mode = ? AND state = ? LIMIT 1', (mode, TODO)
+        ).fetchone()
+        return row is not None
+
+    def count(self, mode, state=TODO):
+        return self._connect().execute(
+            'SELECT COUNT(*) FROM tasks WHERE mode = ? AND state = ?', (mode, state)
+        ).fetchone()[0]
+
+    def claim(self, mode, video_path):
+        """TODO -> CLAIMED for one video, returns the task or None if it is not available."""
+        with self._transaction() as conn:
+            cur = conn.execute(
+                'UPDATE tasks SET state = ?, updated = ? WHERE mode = ? AND video_path = ? AND state = ?',
+                (CLAIMED, time.time(), mode, video_path, TODO),
+            )
+            if cur.rowcount == 0:
+                return None
+            return self._row_to_task(conn.execute(
+                'SELECT * FROM tasks WHERE mode = ? AND video_path = ?', (mode, video_path)
+            ).fetchone())
+
+    def claim_next(self, mode, is_human=None):
+        """Claim the first video in queue order, optionally only (non-)human re-annotation videos."""
+        with self._transaction() as conn:
+            if is_human is None:
+                row = conn.execute(
+                    'SELECT * FROM tasks WHERE mode = ? AND state = ? ORDER BY seq LIMIT 1', (mode, TODO)
+                ).fetchone()
+            else:
+                row = conn.execute(
+                    'SELECT * FROM tasks WHERE mode = ? AND state = ? AND is_human = ? ORDER BY seq LIMIT 1',
+                    (mode, TODO, int(is_human)),
+                ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                'UPDATE tasks SET state = ?, updated = ? WHERE id = ?', (CLAIMED, time.time(), row['id'])
+            )
+            task = self._row_to_task(row)
+            task['state'] = CLAIMED
+            return task
+
+    def update_user_videos(self, mode, user_name, get_usable, video_name=None):
+        """
+        Write the re-annotation rounds of a user (user_history.UserHistory.usable) to
+        the user_videos table: all of them, or only the rows of `video_name`.
+        `get_usable()` returns {round: video names} and runs inside the write
+        transaction, so a concurrent update can not be overwritten by an older view.
+        """
+        with self._transaction() as conn:
+            usable = get_usable()
+            if video_name is None:
+                conn.execute('DELETE FROM user_videos WHERE mode = ? AND user_name = ?', (mode, user_name))
+                rows = [(mode, user_name, i, name) for i, names in usable.items() for name in names]
+            else:
+                conn.execute(
+                    'DELETE FROM user_videos WHERE mode = ? AND user_name = ? AND video_name = ?',
+                    (mode, user_name, video_name),
+                )
+                rows = [(mode, user_name, i, video_name) for i, names in usable.items() if video_name in names]
+            conn.executemany('INSERT INTO user_videos (mode, user_name, round, video_name) VALUES (?, ?, ?, ?)', rows)
+
+    def claim_user_next(self, mode, user_name, round):
+        """Claim the first queued video whose file name is in re-annotation `round` of the user."""
+        with self._transaction() as conn:
+            row = conn.execute(
+                'SELECT tasks.* FROM user_videos JOIN tasks '
+                'ON tasks.mode = user_videos.mode AND tasks.video_name = user_videos.video_name '
+                'WHERE user_videos.mode = ? AND user_videos.user_name = ? AND user_videos.round = ? AND tasks.state = ? '
+                'ORDER BY tasks.seq LIMIT 1',
+                (mode, user_name, round, TODO),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                'UPDATE tasks SET state = ?, updated = ? WHERE id = ?', (CLAIMED, time.time(), row['id'])
+            )
+            task = self._row_to_task(row)
+            task['state'] = CLAIMED
+            return task
+
+    def count_user_available(self, mode, user_name, round):
+        """Number of file names in re-annotation `round` of the user that still have a queued video."""
+        return self._connect().execute(
+            'SELECT COUNT(*) FROM user_videos WHERE mode = ? AND user_name = ? AND round = ? AND EXISTS ('
+            'SELECT 1 FROM tasks WHERE tasks.mode = user_videos.mode AND tasks.video_name = user_videos.video_name '
+            'AND tasks.state = ?)',
+            (mode, user_name, round, TODO),
+        ).fetchone()[0]
+
+    def release(self, mode, video_path):
+        """CLAIMED -> TODO, the video goes back to the end of the queue."""
+        with self._transaction() as conn:
+            cur = conn.execute(
+                'UPDATE tasks SET state = ?, seq = ?, updated = ? WHERE mode = ? AND video_path = ? AND state = ?',
+                (TODO, self._next_seq(conn), time.time(), mode, video_path, CLAIMED),
+            )
+            return cur.rowcount > 0
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class _Transaction:
+    # BEGIN IMMEDIATE takes the write lock up front, so a read-then-update
+    # inside the block can not interleave with another process
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.conn.execute('COMMIT')
+        else:
+            self.conn.execute('ROLLBACK')
+        return False
@@ -0,0 +1,89 @@
+import os
+import sys
+import copy
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "tools"))
+from sam_tools import combine_masks
+
+
+def combine_masks_legacy(masks_list, t=10):
+    # former per object and select frame combine_masks of tools/sam_tools.py, the reference result
+    mask = masks_list[:][0]
+    frame_mask_list = []
+
+    for select_frame_id in range(len(masks_list)):
+        tmp_list = []
+        for obj_id in range(len(masks_list[0])):
+            frame_mask = masks_list[select_frame_id][obj_id].sum(-1).sum(-1).sum(-1)
+            tmp_list.append(frame_mask)
+        frame_mask_list.append(tmp_list)
+
+    for select_frame_id in range(1, len(masks_list)):
+        for obj_id in range(len(masks_list[0])):
+            mask_or = np.logical_or(mask[obj_id], masks_list[select_frame_id][obj_id])
+            mask_and = np.logical_and(mask[obj_id], masks_list[select_frame_id][obj_id])
+            less_frame_mask = frame_mask_list[select_frame_id][obj_id] < frame_mask_list[select_frame_id-1][obj_id]
+            mask_less = np.where(less_frame_mask[:, np.newaxis, np.newaxis, np.newaxis], masks_list[select_frame_id][obj_id], mask[obj_id])
+            mask_and_is_zero_mask = mask_and.sum(-1).sum(-1).sum(-1) < t
+            mask_and = np.where(mask_and_is_zero_mask[:, np.newaxis, np.newaxis, np.newaxis], mask_less, mask_and)
+            frame_mask = np.logical_and(frame_mask_list[select_frame_id][obj_id] > t, frame_mask_list[select_frame_id-1][obj_id] > t)
+            mask[obj_id] = np.where(frame_mask[:, np.newaxis, np.newaxis, np.newaxis], mask_and, mask_or)
+
+    return mask
+
+
+def make_masks_list(rng, num_select_frames, num_objects=3, num_frames=12, height=40, width=48):
+    # per frame: empty, one pixel, small or large boxes, later select frames
+    # often shift the first one a little so both the overlap and the barely
+    # overlapping branches are taken
+    masks_list = []
+    for k in range(num_select_frames):
+        masks = np.zeros((num_objects, num_frames, 1, height, width), dtype=bool)
+        for n in range(num_objects):
+            for t in range(num_frames):
+                kind = rng.integers(0, 5)
+                if kind == 0:
+                    continue
+                if kind == 1:
+                    masks[n, t, 0, rng.integers(0, height), rng.integers(0, width)] = True
+                    continue
+                if kind == 4 and k > 0:
+                    dy, dx = rng.integers(-3, 4, size=2)
+                    masks[n, t] = np.roll(masks_list[0][n, t], (dy, dx), axis=(-2, -1))
+                    continue
+                size = rng.integers(2, 8) if kind == 2 else rng.integers(8, 30)
+                y, x = rng.integers(0, height - size), rng.integers(0, width - size)
+                masks[n, t, 0, y:y + size, x:x + size] = True
+        masks_list.append(masks)
+    return masks_list
+
+
+@pytest.mark.parametrize("device", [None, "cpu"])
+@pytest.mark.parametrize("t", [0, 1, 10, 50])
+@pytest.mark.parametrize("num_select_frames", [1, 2, 4])
+def test_combine_masks_matches_legacy(num_select_frames, t, device):
+    rng = np.random.default_rng(num_select_frames * 100 + t)
+    for _ in range(5):
+        masks_list = make_masks_list(rng, num_select_frames)
+        # both versions write into the first masks
+        expected = combine_masks_legacy(copy.deepcopy(masks_list), t=t)
+        result = combine_masks(copy.deepcopy(masks_list), t=t, device=device)
+        assert result.dtype == np.bool_
+        assert result.shape == expected.shape
+        np.testing.assert_array_equal(result, expected)
+
+
+@pytest.mark.parametrize("device", [None, "cpu"])
+def test_combine_masks_empty_and_one_pixel(device):
+    empty = np.zeros((2, 3, 1, 8, 8), dtype=bool)
+    one_pixel = empty.copy()
+    one_pixel[:, :, 0, 4, 4] = True
+    for masks_list in [[empty, empty], [empty, one_pixel], [one_pixel, empty], [one_pixel, one_pixel]]:
+        for t in [0, 1, 10]:
+            expected = combine_masks_legacy(copy.deepcopy(masks_list), t=t)
+            result = combine_masks(copy.deepcopy(masks_list), t=t, device=device)
+            np.testing.assert_array_equal(result, expected)
@@ -0,0 +1,47 @@
+import os
+import sys
+import queue
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tap_sam.scheduler import SamScheduler
+
+
+class FakeSam:
+    device = "cpu"
+
+    def set_video_list(self, video, video_path, frame_indices, images, video_size):
+        self.video = video
+
+    def __call__(self, points, labels, select_frame, obj_ids, bidirectional, on_frame):
+        masks = np.zeros((len(points), len(self.video), 1, 2, 2), dtype=bool)
+        for frame_idx in range(len(self.video)):
+            on_frame(frame_idx, masks[:, frame_idx])
+        return masks
+
+
+def test_stalled_stream_does_not_block_next_job():
+    scheduler = SamScheduler(FakeSam(), max_wait=0, stream_timeout=0.3)
+    objects = [([[0, 0]], [1])]
+    # the consumer of this queue never reads, the pass fills it after 2 frames
+    stalled = scheduler.submit(np.zeros((10, 2, 2, 3)), "a.mp4", (0, 10), objects, frame_queue=queue.Queue(maxsize=2))
+    other = scheduler.submit(np.zeros((5, 2, 2, 3)), "b.mp4", (0, 5), objects)
+    assert other.result(timeout=5).shape == (1, 5, 1, 2, 2)
+    with pytest.raises(TimeoutError):
+        stalled.result(timeout=5)
+
+
+def test_stream_gets_frames_then_none():
+    scheduler = SamScheduler(FakeSam(), max_wait=0)
+    frame_queue = queue.Queue(maxsize=2)
+    future = scheduler.submit(np.zeros((4, 2, 2, 3)), "a.mp4", (0, 4), [([[0, 0]], [1])], frame_queue=frame_queue)
+    frame_indices = []
+    while True:
+        item = frame_queue.get(timeout=5)
+        if item is None:
+            break
+        frame_indices.append(item[0])
+    assert frame_indices == [0, 1, 2, 3]
+    assert future.result(timeout=5).shape == (1, 4, 1, 2, 2)
@@ -0,0 +1,44 @@
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from user_history import HistoryJournal
+
+
+def test_append_after_torn_tail():
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, "user.txt")
+        # a writer crashed in the middle of the second line
+        with open(path, "wb") as f:
+            f.write(b"/a/v0.mp4\n/a/v1")
+        journal = HistoryJournal(path)
+        journal.append("/a/v2.mp4")
+        journal.close()
+        lines, _, _, _ = journal.read()
+        assert lines == ["/a/v0.mp4", "/a/v2.mp4"]
+
+
+def test_append_after_torn_only_line():
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, "user.txt")
+        with open(path, "wb") as f:
+            f.write(b"/a/v")
+        journal = HistoryJournal(path)
+        journal.append("/a/v2.mp4")
+        journal.append("/a/v3.mp4")
+        journal.close()
+        lines, _, _, _ = journal.read()
+        assert lines == ["/a/v2.mp4", "/a/v3.mp4"]
+
+
+def test_append_keeps_complete_lines():
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, "user.txt")
+        journal = HistoryJournal(path)
+        for i in range(3):
+            journal.append(f"/a/v{i}.mp4")
+        journal.close()
+        lines, offset, _, _ = journal.read()
+        assert lines == ["/a/v0.mp4", "/a/v1.mp4", "/a/v2.mp4"]
+        assert offset == os.path.getsize(path)
@@ -0,0 +1,74 @@
+import os
+import sys
+import time
+import argparse
+import yaml
+import numpy as np
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tap_sam.sam import Sam
+from tap_sam.vis_utils import extract_frames
+
+
+def mask_iou(masks, reference):
+    # per object IoU over all frames, objects missing in both count as 1
+    masks = masks.reshape(len(masks), -1)
+    reference = reference.reshape(len(reference), -1)
+    intersection = np.logical_and(masks, reference).sum(1)
+    union = np.logical_or(masks, reference).sum(1)
+    return np.where(union > 0, intersection / np.maximum(union, 1), 1.0)
+
+
+def run(sam_config, video, points, labels, **profile):
+    model_sam = Sam(
+        sam_config["sam_ckpt_path"],
+        sam_config["model_config"],
+        sam_config["threshold"],
+        False,
+        sam_config["device"],
+        **profile,
+    )
+    # the first pass compiles / autotunes, the second one is timed
+    for _ in range(2):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.time()
+        model_sam.set_video_list(video, "check_sam_profile")
+        masks = model_sam(points, labels, 0, list(range(len(points))))
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+    return masks, time.time() - start
+
+
+if __name__ == '__main__':
+    # compares the masks of a precision / compile profile with fp32 before it goes into config.yaml
+    args = argparse.ArgumentParser()
+    args.add_argument('--config', type=str, default='./config/config.yaml')
+    args.add_argument('--video', type=str, default=None, help='defaults to sam.video_path of the config')
+    args.add_argument('--points', type=str, nargs='+', required=True, help='one x,y click per object on the first frame')
+    args.add_argument('--frames', type=int, default=100)
+    args.add_argument('--precision', type=str, default='bf16', choices=['fp32', 'bf16', 'fp16'])
+    args.add_argument('--compile', action='store_true')
+    args.add_argument('--channels_last', action='store_true')
+    args.add_argument('--min_iou', type=float, default=0.95)
+    args = args.parse_args()
+
+    with open(args.config) as f:
+        sam_config = yaml.load(f, Loader=yaml.FullLoader)['sam']
+    video = extract_frames(args.video or sam_config['video_path'], 0, args.frames)
+    points = [np.array([[float(v) for v in point.split(',')]]) for point in args.points]
+    labels = [np.array([1]) for _ in points]
+
+    reference, reference_time = run(sam_config, video, points, labels)
+    masks, profile_time = run(
+        sam_config, video, points, labels,
+        precision=args.precision, compile=args.compile, channels_last=args.channels_last,
+    )
+    iou = mask_iou(masks, reference)
+    print(f'fp32: {reference_time:.2f}s, {args.precision}: {profile_time:.2f}s ({reference_time / profile_time:.2f}x) on {len(video)} frames')
+    for obj_idx, obj_iou in enumerate(iou):
+        print(f'object {obj_idx}: IoU {obj_iou:.4f} with fp32')
+    if iou.min() < args.min_iou:
+        print(f'IoU below {args.min_iou}, keep this profile out of config.yaml')
+        sys.exit(1)
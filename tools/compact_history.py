@@ -0,0 +1,26 @@
+import os
+import sys
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from user_history import HistoryJournal, FINISH
+
+ROOT_DIR = '/mnt/hwfile/OpenRobotLab/Annotation4Manipulation'
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    args.add_argument('--root', type=str, default=ROOT_DIR)
+    args.add_argument('--mode', type=str, nargs='+', default=['sam', 'lang'])
+    args = args.parse_args()
+
+    # safe while the servers are running, appends wait for the journal lock
+    for mode in args.mode:
+        save_dir = os.path.join(args.root, 'user_config', mode)
+        if not os.path.isdir(save_dir):
+            continue
+        for file_name in sorted(os.listdir(save_dir)):
+            if not file_name.endswith('.txt'):
+                continue
+            journal = HistoryJournal(os.path.join(save_dir, file_name))
+            before, after = journal.compact(unique=file_name.endswith(f'{FINISH}.txt'))
+            print(f'{mode}/{file_name}: {before} -> {after} lines')
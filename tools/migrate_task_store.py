@@ -0,0 +1,33 @@
+import os
+import sys
+import json
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from task_store import TaskStore, TODO, CLAIMED
+
+ROOT_DIR = '/mnt/hwfile/OpenRobotLab/Annotation4Manipulation'
+
+def migrate(store, root_dir, mode):
+    # has_annotation first, so a video listed in both files ends up queued
+    for file_name, state in [(f'has_annotation_{mode}.json', CLAIMED), (f'no_annotation_{mode}.json', TODO)]:
+        path = os.path.join(root_dir, file_name)
+        if not os.path.exists(path):
+            print(f'{path} not found, skip')
+            continue
+        with open(path, 'r') as f:
+            tasks = json.load(f)
+        store.add_many(mode, tasks.items(), state)
+        print(f'{mode}: import {len(tasks)} videos from {file_name}')
+    print(f'{mode}: {store.count(mode, TODO)} queued, {store.count(mode, CLAIMED)} claimed')
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    args.add_argument('--root', type=str, default=ROOT_DIR, help='folder of the json files written by tools/parse_anno.py')
+    args.add_argument('--db', type=str, default=None, help='task store path, default <root>/task_store.db')
+    args.add_argument('--mode', type=str, nargs='+', default=['sam', 'lang'])
+    args = args.parse_args()
+
+    store = TaskStore(args.db or os.path.join(args.root, 'task_store.db'))
+    for mode in args.mode:
+        migrate(store, args.root, mode)
@@ -3,11 +3,14 @@ import numpy as np
 import cv2, os, yaml
 import multiprocessing
 import concurrent.futures
-from tap_sam.vis_utils import extract_frames
-from sam_tools import predict_sam_video, predict_sam_video_multiframe, get_sam_mask_on_image_forward_mutli
+from tap_sam.video_io import iter_video, write_video
+from sam_tools import predict_sam_video, predict_sam_video_multiframe, iter_synthesis_image_multi
 from tqdm import tqdm
 import argparse, json
 from tap_sam.sam import Sam
+from tap_sam.frame_cache import FrameCache, set_frame_cache
+from tap_sam import mask_io
+from task_store import TaskStore, TODO
 
 USER_PATH = '/mnt/hwfile/OpenRobotLab/Annotation4Manipulation/user_config/sam/' 
 CONFIG_PATH = '/mnt/hwfile/OpenRobotLab/Annotation4Manipulation/{mode}/data/ann_human/{time}/sam/'
@@ -18,6 +21,8 @@ ROOT_DIR = '/mnt/hwfile/OpenRobotLab/Annotation4Manipulation'
 RH20T = 'RH20T'
 DROID = 'OXE_DROID'
 UPDATE_VIDEO_LIST = []
+# frames in flight between decoding, overlay and encoding of the result videos
+RENDER_QUEUE_SIZE = 16
 
 def load_sam_input_config(path):
     sam_config = pickle.load(open(path, "rb"))
@@ -68,8 +73,9 @@ def parse_and_save_results(line, model_sam):
     else:
         time = 0
     video_save_path = os.path.join(VIDEO_SAVE_PATH.format(mode=mode, time=str(time)),  line.split('/')[-1])
-    sam_save_path = os.path.join(SAM_SAVE_PATH.format(mode=mode, time=str(time)), line.split('/')[-1].replace('.mp4', '.npz'))
-    if os.path.exists(video_save_path) and os.path.exists(sam_save_path):
+    sam_save_path = os.path.join(SAM_SAVE_PATH.format(mode=mode, time=str(time)), line.split('/')[-1].replace('.mp4', mask_io.EXTENSION))
+    # results of earlier rounds may still be .npz
+    if os.path.exists(video_save_path) and mask_io.find_masks(sam_save_path) is not None:
         return
     
     model_config_path = os.path.join(CONFIG_PATH.format(mode=mode, time=str(time)), line.split('/')[-1].replace('.mp4', '.npz'))
@@ -77,33 +83,39 @@ def parse_and_save_results(line, model_sam):
     if model_config['is_finished']:
         return
     if time == 0:
-        mask_list = predict_sam_video_multiframe(model_config, model_sam, sam_save_path, time=time, combined_mask=False)
+        predict_sam_video_multiframe(model_config, model_sam, sam_save_path, time=time, combined_mask=False)
     elif time == 1:
-        mask_list = predict_sam_video_multiframe(model_config, model_sam, sam_save_path, time=time, combined_mask=True)
+        predict_sam_video_multiframe(model_config, model_sam, sam_save_path, time=time, combined_mask=True)
     elif time == 2:
-        mask_list = predict_sam_video_multiframe(model_config, model_sam, sam_save_path, time=time, combined_mask=True)
+        predict_sam_video_multiframe(model_config, model_sam, sam_save_path, time=time, combined_mask=True)
     elif time == 3:
-        mask_list = predict_sam_video_multiframe(model_config, model_sam, sam_save_path, time=time, combined_mask=True)
+        predict_sam_video_multiframe(model_config, model_sam, sam_save_path, time=time, combined_mask=True)
         return
     
-    # mask_list = np.load(sam_save_path)['masks']
+    # render from the saved masks one frame at a time: decode -> overlay -> encode
+    # overlap in their own threads and only RENDER_QUEUE_SIZE frames are held at once
+    select_frames = model_config["select_frames"]
+    if len(select_frames) == 0:
+        return
     video_path = model_config['video_path']
     video_name = video_path.split('/')[-1]
     origin_video_path = os.path.join(ROOT_DIR, mode, 'data', 'video', video_name)
-    video = extract_frames(origin_video_path)
-    # video, width, height = get_sam_mask_on_image_bidirection(model_config, mask_list, video, select_frame)
-    video_new, width, height = get_sam_mask_on_image_forward_mutli(model_config, mask_list, video)
-    # if model_config["direction"] == "forward":
-    #     video_new = np.concatenate([video[:select_frame], np.array(video_new)], axis=0)
-    # elif model_config["direction"] == "backward":
-    #     video_new = np.concatenate([np.array(video_new), video[select_frame+1:]], axis=0)
-    
-    result = cv2.VideoWriter(
-        video_save_path, cv2.VideoWriter_fourcc(*"XVID"), 20, (width, height)
-    )
-    for i in range(len(video_new)):
-        result.write(video_new[i])
-    result.release()
+    # written next to the result and renamed once the video and masks had as many
+    # frames, a partial video would be skipped as done by the next run
+    root, ext = os.path.splitext(video_save_path)
+    tmp_save_path = root + ".tmp" + ext
+    try:
+        with mask_io.MaskReader(sam_save_path) as reader:
+            frames = iter_video(origin_video_path, rgb=False, prefetch=RENDER_QUEUE_SIZE)
+            frame_masks = (reader.read_frame(i) for i in range(reader.num_frames))
+            video_new = iter_synthesis_image_multi(
+                frames, frame_masks, model_config["positive_points"], model_config["negative_points"], select_frames
+            )
+            write_video(tmp_save_path, video_new, 20, "XVID", queue_size=RENDER_QUEUE_SIZE)
+        os.replace(tmp_save_path, video_save_path)
+    finally:
+        if os.path.exists(tmp_save_path):
+            os.remove(tmp_save_path)
     
     UPDATE_VIDEO_LIST.append(video_save_path)
         
@@ -119,32 +131,35 @@ if __name__ == "__main__":
         sam_config["threshold"],
         False,
         sam_config["device"],
+        precision=sam_config.get("precision", "fp32"),
+        compile=sam_config.get("compile", False),
+        channels_last=sam_config.get("channels_last", False),
+        num_threads=sam_config.get("num_threads", None),
+        cpu_model_cfg=sam_config.get("cpu_model_config", None),
+        cpu_checkpoint=sam_config.get("cpu_sam_ckpt_path", None),
     )
     args = argparse.ArgumentParser()
     args.add_argument('--name', type=str)
     args.add_argument('--time', type=int, default=0)
+    args.add_argument('--frame_cache_gb', type=float, default=8, help='decoded frames reused across select frames, 0 disables')
+    args.add_argument('--frame_cache_dir', type=str, default=None)
     args = args.parse_args()
+    if args.frame_cache_gb > 0:
+        set_frame_cache(FrameCache(int(args.frame_cache_gb * (1 << 30)), args.frame_cache_dir))
     
     check_person(args.name, args.time, model_sam)
     
-    # save UPDATE_VIDEO_LIST to a file
+    # queue UPDATE_VIDEO_LIST for the next annotation round
     add_file_number = 0
-    with open(os.path.join(ROOT_DIR, 'no_annotation_sam.json'), 'r+') as f:
-        no_annotation = json.load(f)
-        for video_path in UPDATE_VIDEO_LIST:
-            assert video_path not in no_annotation
-            mode = RH20T if RH20T in video_path else DROID
-            time = int(video_path.split('/')[-3])
-            add_file_number += 1
-            video_name = video_path.split('/')[-1]
-            save_path = os.path.join(ROOT_DIR, RH20T, 'data', 'ann_human', str(time+1), 'sam', video_name.replace('.mp4', '.npz'))
-            no_annotation[video_path] = {
-                'anno_path': '',
-                'save_path': save_path
-            }
-        f.seek(0)
-        f.truncate()
-        json.dump(no_annotation, f)
+    task_store = TaskStore(os.path.join(ROOT_DIR, 'task_store.db'))
+    for video_path in UPDATE_VIDEO_LIST:
+        task = task_store.get('sam', video_path)
+        assert task is None or task['state'] != TODO
+        mode = RH20T if RH20T in video_path else DROID
+        time = int(video_path.split('/')[-3])
+        add_file_number += 1
+        video_name = video_path.split('/')[-1]
+        save_path = os.path.join(ROOT_DIR, RH20T, 'data', 'ann_human', str(time+1), 'sam', video_name.replace('.mp4', '.npz'))
+        task_store.add('sam', video_path, anno_path='', save_path=save_path)
     
-    print(f'Add {add_file_number} files to no_annotation_sam')
-    
\ No newline at end of file
+    print(f'Add {add_file_number} files to task store')
@@ -0,0 +1,37 @@
+import os
+import sys
+import argparse
+from tqdm import tqdm
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tap_sam.input_store import InputStore
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv')
+
+
+def list_videos(paths):
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, _, file_names in os.walk(path):
+            for file_name in sorted(file_names):
+                if file_name.endswith(VIDEO_EXTENSIONS) and not file_name.startswith('.'):
+                    yield os.path.join(root, file_name)
+
+
+if __name__ == '__main__':
+    # fills the input store of the SAM server ahead of the annotators, see sam.input_store in the config
+    args = argparse.ArgumentParser()
+    args.add_argument('videos', type=str, nargs='+', help='videos or folders of videos')
+    args.add_argument('--image_size', type=int, default=1024)
+    args.add_argument('--store_dir', type=str, default=None)
+    args.add_argument('--device', type=str, default='cuda')
+    args.add_argument('--batch_size', type=int, default=32)
+    args.add_argument('--force', action='store_true', help='rebuild up-to-date inputs too')
+    args = args.parse_args()
+
+    store = InputStore(args.image_size, args.store_dir, device=args.device, batch_size=args.batch_size)
+    for video_path in tqdm(list(list_videos(args.videos))):
+        if args.force or not store.is_valid(video_path):
+            store.build(video_path)
@@ -1,8 +1,9 @@
 import torch
 import cv2
 import numpy as np
-from tap_sam.vis_utils import extract_frames
-import matplotlib.pyplot as plt
+from tap_sam.vis_utils import extract_sam_frames
+from tap_sam.mask_io import write_masks, copy_masks, update_masks
+from tap_sam.overlay import MaskOverlay, get_colors, render_masks
 import copy
 
 def forward_sam_multi(model_config, model_sam):
@@ -12,13 +13,10 @@ def forward_sam_multi(model_config, model_sam):
     direction = model_config["direction"]
 
     temp_image_list_save_dir = video_path.rsplit(".", 1)[0]
-    video = extract_frames(video_path)
-    if not is_video:
-        video = video[select_frame:select_frame + 1]
-    elif direction == "forward":
-        video = video[select_frame:]     
-    elif direction == "backward":
-        video = video[:select_frame+1][::-1]
+    video, frame_indices = extract_sam_frames(video_path, select_frame, is_video, direction)
+    # bidirection tracks both ways from select_frame on the full video
+    bidirectional = is_video and direction == "bidirection"
+    prompt_frame = select_frame if bidirectional else 0
     
     positive_points_dict = model_config["positive_points"][select_frame]
     negative_points_dict = model_config["negative_points"][select_frame]
@@ -34,7 +32,7 @@ def forward_sam_multi(model_config, model_sam):
             positive_points[i] = np.concatenate([positive_points[i], negative_points[i]], axis=0)
     # if len(negative_points) != 0:
     #     positive_points = np.concatenate([positive_points, negative_points], axis=0)
-    masks_all = model_sam(positive_points, labels, 0, list(positive_points_dict.keys()))
+    masks_all = model_sam(positive_points, labels, prompt_frame, list(positive_points_dict.keys()), bidirectional)
         # mask_all.append(masks)
     
     return masks_all
@@ -46,13 +44,10 @@ def forward_sam(model_config, model_sam):
     direction = model_config["direction"]
 
     temp_image_list_save_dir = video_path.rsplit(".", 1)[0]
-    video = extract_frames(video_path)
-    if not is_video:
-        video = video[select_frame:select_frame + 1]
-    elif direction == "forward":
-        video = video[select_frame:]     
-    elif direction == "backward":
-        video = video[:select_frame+1][::-1]
+    video, frame_indices = extract_sam_frames(video_path, select_frame, is_video, direction)
+    # bidirection tracks both ways from select_frame on the full video
+    bidirectional = is_video and direction == "bidirection"
+    prompt_frame = select_frame if bidirectional else 0
     
     positive_points_dict = model_config["positive_points"]
     negative_points_dict = model_config["negative_points"]
@@ -68,41 +63,35 @@ def forward_sam(model_config, model_sam):
             positive_points[i] = np.concatenate([positive_points[i], negative_points[i]], axis=0)
     # if len(negative_points) != 0:
     #     positive_points = np.concatenate([positive_points, negative_points], axis=0)
-    masks_all = model_sam(positive_points, labels, 0, list(positive_points_dict.keys()))
+    masks_all = model_sam(positive_points, labels, prompt_frame, list(positive_points_dict.keys()), bidirectional)
         # mask_all.append(masks)
     
     return masks_all
 
 def bidirectional_sam(model_config, model_sam):
-    model_config["direction"] = "forward"
-    masks_forward = forward_sam(model_config, model_sam)
-    if model_config['select_frame'] == 0:
-        return masks_forward
-    model_config["direction"] = "backward"
-    masks_backward = forward_sam(model_config, model_sam)
-    
-    # mask_image = mask_images_backward[::-1][:-1] + mask_images_forward
-    masks = []
-    for obj_id in range(len(masks_forward)):
-        masks.append(np.concatenate([masks_backward[obj_id][::-1][:-1], masks_forward[obj_id]], axis=0))
-    
-    return masks
+    # one inference state on the full video, propagated forward and then backward
+    model_config["direction"] = "bidirection"
+    return forward_sam(model_config, model_sam)
 
 def bidirectional_sam_multi(model_config, model_sam):
-    model_config["direction"] = "forward"
-    masks_forward = forward_sam_multi(model_config, model_sam)
-    if model_config['select_frame'] == 0:
-        return masks_forward
-    model_config["direction"] = "backward"
-    masks_backward = forward_sam_multi(model_config, model_sam)
-    
-    # mask_image = mask_images_backward[::-1][:-1] + mask_images_forward
-    masks = []
-    for obj_id in range(len(masks_forward)):
-        masks.append(np.concatenate([masks_backward[obj_id][::-1][:-1], masks_forward[obj_id]], axis=0))
-    
-    return masks
+    model_config["direction"] = "bidirection"
+    return forward_sam_multi(model_config, model_sam)
       
+def save_sam_masks(masks, model_config, save_path, time, combined_mask=False):
+    # the masks are only written, read them back frame by frame with mask_io.MaskReader
+    if combined_mask:
+        assert time > 0, "time should be larger than 0 when combined_mask is True"
+    if not combined_mask or model_config["direction"] == "bidirection":
+        write_masks(save_path, masks)
+        return
+    # start from a copy of the previous round and rewrite only the tracked frames in place
+    select_frame = model_config["select_frame"]
+    copy_masks(save_path.replace(f"/{str(time)}/", f"/{str(time-1)}/"), save_path)
+    if model_config["direction"] == "forward":
+        update_masks(save_path, masks, select_frame)
+    elif model_config["direction"] == "backward":
+        update_masks(save_path, masks[:, ::-1], 0)
+
 def predict_sam_video(model_config, model_sam, save_path, time, combined_mask=False):
 
     if model_config["direction"] == "bidirection":
@@ -110,28 +99,10 @@ def predict_sam_video(model_config, model_sam, save_path, time, combined_mask=Fa
     else:
         masks = forward_sam(copy.deepcopy(model_config), model_sam)
 
-    masks = np.array(masks).astype(np.bool_)
-    if combined_mask:
-        assert time > 0, "time should be larger than 0 when combined_mask is True"
-        select_frame = model_config["select_frame"]
-        pre_mask = np.load(save_path.replace(f"/{str(time)}/", f"/{str(time-1)}/"))["masks"]
-        if model_config["direction"] == "bidirection":
-            new_mask = masks
-        elif model_config["direction"] == "forward":
-            new_mask = np.zeros_like(pre_mask).astype(np.bool_)
-            new_mask[:, select_frame:] = masks
-            new_mask[:, :select_frame] = pre_mask[:, :select_frame]
-        elif model_config["direction"] == "backward":
-            new_mask = np.zeros_like(pre_mask).astype(np.bool_)
-            new_mask[:, :select_frame+1] = masks[:, ::-1]
-            new_mask[:, select_frame+1:] = pre_mask[:, select_frame+1:]
-        masks = new_mask
-    
-    np.savez_compressed(save_path, masks=masks)
+    save_sam_masks(np.array(masks).astype(np.bool_), model_config, save_path, time, combined_mask)
     print(f"Finish processing {model_config['video_path']}")
     
     torch.cuda.empty_cache()
-    return masks
 
 def predict_sam_video_multiframe(model_config, model_sam, save_path, time, combined_mask=False):
     select_frames = model_config["select_frames"]
@@ -149,52 +120,51 @@ def predict_sam_video_multiframe(model_config, model_sam, save_path, time, combi
         model_config["select_frame"] = select_frames[0]
         masks = forward_sam_multi(copy.deepcopy(model_config), model_sam)
 
-    masks = np.array(masks).astype(np.bool_)
-    if combined_mask:
-        assert time > 0, "time should be larger than 0 when combined_mask is True"
-        select_frame = model_config["select_frame"]
-        pre_mask = np.load(save_path.replace(f"/{str(time)}/", f"/{str(time-1)}/"))["masks"]
-        if model_config["direction"] == "bidirection":
-            new_mask = masks
-        elif model_config["direction"] == "forward":
-            new_mask = np.zeros_like(pre_mask).astype(np.bool_)
-            new_mask[:, select_frame:] = masks
-            new_mask[:, :select_frame] = pre_mask[:, :select_frame]
-        elif model_config["direction"] == "backward":
-            new_mask = np.zeros_like(pre_mask).astype(np.bool_)
-            new_mask[:, :select_frame+1] = masks[:, ::-1]
-            new_mask[:, select_frame+1:] = pre_mask[:, select_frame+1:]
-        masks = new_mask
-    
-    np.savez_compressed(save_path, masks=masks)
+    save_sam_masks(np.array(masks).astype(np.bool_), model_config, save_path, time, combined_mask)
     print(f"Finish processing {model_config['video_path']}")
     
     torch.cuda.empty_cache()
-    return masks
-
-def combine_masks(masks_list, t=10):
-    mask = masks_list[:][0]
-    frame_mask_list = []
-    
-    for select_frame_id in range(len(masks_list)):
-        tmp_list = []
-        for obj_id in range(len(masks_list[0])):
-            frame_mask = masks_list[select_frame_id][obj_id].sum(-1).sum(-1).sum(-1)
-            tmp_list.append(frame_mask)
-        frame_mask_list.append(tmp_list)
 
+def _frame_areas(masks):
+    # pixel count of every row of (N * T, H * W) masks
+    if isinstance(masks, np.ndarray):
+        return masks.view(np.uint8).sum(-1, dtype=np.int32)
+    return masks.sum(-1)
+
+def combine_masks(masks_list, t=10, device=None):
+    """
+    Merge the (N, T, 1, H, W) masks tracked from several select frames, in order:
+    where both the merged and the next masks of a frame are larger than `t` pixels
+    their intersection is kept (the smaller mask when they barely overlap),
+    otherwise their union. All objects and frames are merged at once as rows of
+    (N * T, H * W) masks, on the torch `device` when given.
+    """
+    shape = np.shape(masks_list[0])
+    if device is not None:
+        masks_list = [torch.as_tensor(np.asarray(masks)).to(device).reshape(shape[0] * shape[1], -1) for masks in masks_list]
+    else:
+        masks_list = [np.ascontiguousarray(masks, dtype=np.bool_).reshape(shape[0] * shape[1], -1) for masks in masks_list]
+    # one area pass per select frame
+    areas = [_frame_areas(masks) for masks in masks_list]
+    mask = masks_list[0]
     for select_frame_id in range(1, len(masks_list)):
-        for obj_id in range(len(masks_list[0])):
-            mask_or = np.logical_or(mask[obj_id], masks_list[select_frame_id][obj_id])
-            mask_and = np.logical_and(mask[obj_id], masks_list[select_frame_id][obj_id])
-            less_frame_mask = frame_mask_list[select_frame_id][obj_id] < frame_mask_list[select_frame_id-1][obj_id]
-            mask_less = np.where(less_frame_mask[:, np.newaxis, np.newaxis, np.newaxis], masks_list[select_frame_id][obj_id], mask[obj_id])
-            mask_and_is_zero_mask = mask_and.sum(-1).sum(-1).sum(-1) < t
-            mask_and = np.where(mask_and_is_zero_mask[:, np.newaxis, np.newaxis, np.newaxis], mask_less, mask_and)
-            frame_mask = np.logical_and(frame_mask_list[select_frame_id][obj_id] > t, frame_mask_list[select_frame_id-1][obj_id] > t)
-            mask[obj_id] = np.where(frame_mask[:, np.newaxis, np.newaxis, np.newaxis], mask_and, mask_or)
-    
-    return mask
+        masks = masks_list[select_frame_id]
+        area, previous_area = areas[select_frame_id], areas[select_frame_id - 1]
+        # frames where both masks are large enough are intersected (the smaller
+        # mask when they barely overlap), the others are united
+        both = (area > t) & (previous_area > t)
+        mask_and = mask[both] & masks[both]
+        overlap = _frame_areas(mask_and) >= t
+        use_less = both & (area < previous_area)
+        use_less[both] &= ~overlap
+        use_and = both.clone() if device is not None else both.copy()
+        use_and[both] = overlap
+        mask[use_and] = mask_and[overlap]
+        mask[use_less] = masks[use_less]
+        mask[~both] |= masks[~both]
+    if device is not None:
+        mask = mask.cpu().numpy()
+    return mask.reshape(shape)
 
 def get_sam_mask_on_image_forward_mutli(model_config, masks_list, video):
     # is_video = model_config["is_video"]
@@ -231,115 +201,55 @@ def get_sam_mask_on_image_bidirection(model_config, masks_list, video, select_fr
     
     return mask_image, width, height
 
+def iter_synthesis_image_multi(frames, frame_masks, positive_points_dict, negative_points_dict, select_frames, alpha=0.5):
+    # synthesis_image_multi one frame at a time, the frames are drawn on in place;
+    # raises ValueError when there are not as many frames as masks
+    obj_ids = list(positive_points_dict[select_frames[0]].keys())
+    overlay = MaskOverlay(get_colors(obj_ids), alpha)
+    frames = iter(frames)
+    num_masks = 0
+    for i, masks in enumerate(frame_masks):
+        num_masks += 1
+        frame = next(frames, None)
+        if frame is None:
+            raise ValueError(f"video has {i} frames, masks have more")
+        overlay.draw(frame, masks)
+        if i in select_frames:
+            # also draw the points on the mask
+            for obj_id in range(len(masks)):
+                for point in positive_points_dict[i][obj_id]:
+                    # green for positive points
+                    cv2.circle(frame, (point[0], point[1]), 3, (0, 255, 0), -1)
+                for point in negative_points_dict[i][obj_id]:
+                    # red for negative points
+                    cv2.circle(frame, (point[0], point[1]), 3, (0, 0, 255), -1)
+        yield frame
+    if next(frames, None) is not None:
+        raise ValueError(f"masks have {num_masks} frames, video has more")
+
 def synthesis_image_multi(masks_list, video, positive_points_dict, negative_points_dict, select_frames=[], alpha=0.5):
     if len(select_frames) == 0:
         return None, None, None
     
-    obj_ids = list(positive_points_dict[select_frames[0]].keys())
-    cmap = plt.get_cmap("tab10")
-    colors = [np.array([*cmap(int(i))[:3]]) for i in obj_ids]
-    mask_image = [torch.tensor(masks_list[i]).permute(2, 3, 1, 0).numpy() * (
-        colors[i].reshape(1, 1, -1)[:, :, :, None]
-    ) for i in range(len(masks_list))]
-    
-    mask_image = [
-        (torch.tensor(mask_image[i]).permute(3, 0, 1, 2) * 255)
-        .numpy()
-        .astype(np.uint8) for i in range(len(mask_image))
-    ]
-    
-    mask_image = [((1-alpha) * video + alpha * mask_image[i]).astype(np.uint8) for i in range(len(mask_image))]
-    mix_image_list = []
-
-    # add mask to video
-    width, height = mask_image[0][0].shape[1], mask_image[0][0].shape[0]
-    text_scale = width / 800
-    assert video.shape[0] == mask_image[0].shape[0], f"video shape: {video.shape[0]}, mask shape: {mask_image[0].shape[0]}"
-    for i in range(video.shape[0]):      
-        for obj_id in range(len(masks_list)):
-            mix_mask = masks_list[obj_id][i][0][:, :, None].repeat(3, axis=2)
-            mix_image = np.where(mix_mask, mask_image[obj_id][i], video[i]) if obj_id == 0 else np.where(mix_mask, mask_image[obj_id][i], mix_image)
-            # write number on the mask in the image by cv2
-            loc = np.where(mix_mask[:,:,0])
-            if len(loc[0]) == 0:
-                continue
-            loc = (np.mean(loc[0]).astype(int), np.mean(loc[1]).astype(int))
-            
-            if loc[0] < 10:
-                loc = (10, loc[1])
-            if loc[1] < 10:
-                loc = (loc[0], 10)
-            if loc[0] > height - 10:
-                loc = (height - 10, loc[1])
-            if loc[1] > width - 10:
-                loc = (loc[0], width - 10)
-            
-            cv2.putText(mix_image, str(obj_id+1), (loc[1], loc[0]), cv2.FONT_HERSHEY_TRIPLEX, text_scale, (255, 255, 255), 1, cv2.LINE_AA)
-            
-            # also draw point on the mask
-            if i in select_frames:
-                p_points = positive_points_dict[i][obj_id]
-                for point in p_points:
-                    # green for positive points
-                    cv2.circle(mix_image, (point[0], point[1]), 3, (0, 255, 0), -1)
-                n_points = negative_points_dict[i][obj_id]
-                for point in n_points:
-                    # red for negative points
-                    cv2.circle(mix_image, (point[0], point[1]), 3, (0, 0, 255), -1)
-        
-        mix_image_list.append(mix_image)
+    masks_list = np.asarray(masks_list)
+    assert video.shape[0] == masks_list.shape[1], f"video shape: {video.shape[0]}, mask shape: {masks_list.shape[1]}"
+    frames = (np.array(frame) for frame in video)
+    frame_masks = (masks_list[:, i] for i in range(len(video)))
+    mix_image_list = list(iter_synthesis_image_multi(frames, frame_masks, positive_points_dict, negative_points_dict, select_frames, alpha))
+    height, width = video.shape[1:3]
     
     return mix_image_list, width, height
 
 def synthesis_image(masks_list, video, positive_points_dict, select_frame, alpha=0.5):
     
     obj_ids = list(positive_points_dict.keys())
-    cmap = plt.get_cmap("tab10")
-    colors = [np.array([*cmap(int(i))[:3]]) for i in obj_ids]
-    mask_image = [torch.tensor(masks_list[i]).permute(2, 3, 1, 0).numpy() * (
-        colors[i].reshape(1, 1, -1)[:, :, :, None]
-    ) for i in range(len(masks_list))]
-    
-    mask_image = [
-        (torch.tensor(mask_image[i]).permute(3, 0, 1, 2) * 255)
-        .numpy()
-        .astype(np.uint8) for i in range(len(mask_image))
-    ]
-    
-    mask_image = [((1-alpha) * video + alpha * mask_image[i]).astype(np.uint8) for i in range(len(mask_image))]
-    mix_image_list = []
-
-    # add mask to video
-    width, height = mask_image[0][0].shape[1], mask_image[0][0].shape[0]
-    text_scale = width / 800
-    assert video.shape[0] == mask_image[0].shape[0], f"video shape: {video.shape[0]}, mask shape: {mask_image[0].shape[0]}"
-    for i in range(video.shape[0]):      
+    colors = get_colors(obj_ids)
+    mix_image_list = render_masks(video, masks_list, colors, alpha)
+    height, width = mix_image_list[0].shape[:2]
+    if select_frame < len(mix_image_list):
+        # also draw the points on the mask
         for obj_id in range(len(masks_list)):
-            mix_mask = masks_list[obj_id][i][0][:, :, None].repeat(3, axis=2)
-            mix_image = np.where(mix_mask, mask_image[obj_id][i], video[i]) if obj_id == 0 else np.where(mix_mask, mask_image[obj_id][i], mix_image)
-            # write number on the mask in the image by cv2
-            loc = np.where(mix_mask[:,:,0])
-            if len(loc[0]) == 0:
-                continue
-            loc = (np.mean(loc[0]).astype(int), np.mean(loc[1]).astype(int))
-            
-            if loc[0] < 10:
-                loc = (10, loc[1])
-            if loc[1] < 10:
-                loc = (loc[0], 10)
-            if loc[0] > height - 10:
-                loc = (height - 10, loc[1])
-            if loc[1] > width - 10:
-                loc = (loc[0], width - 10)
-            
-            cv2.putText(mix_image, str(obj_id+1), (loc[1], loc[0]), cv2.FONT_HERSHEY_TRIPLEX, text_scale, (255, 255, 255), 1, cv2.LINE_AA)
-            
-            # also draw point on the mask
-            if i == select_frame:
-                points = positive_points_dict[obj_id]
-                for point in points:
-                    cv2.circle(mix_image, (point[0], point[1]), 3, colors[obj_id], -1)
-        
-        mix_image_list.append(mix_image)
+            for point in positive_points_dict[obj_id]:
+                cv2.circle(mix_image_list[select_frame], (point[0], point[1]), 3, colors[obj_id], -1)
     
     return mix_image_list, width, height
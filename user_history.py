@@ -0,0 +1,315 @@
+import os
+import time
+import atexit
+import weakref
+import threading
+import portalocker
+from collections import OrderedDict
+from task_store import get_video_name
+
+FINISH = '_finish'
+# history file suffix of each annotation round
+ROUNDS = ['', '_1', '_2', '_3']
+MODE_SUFFIXES = {
+    'sam': ROUNDS + [FINISH],
+    'lang': ['', FINISH],
+}
+# history saves are fsynced at least every FSYNC_BATCH lines or FSYNC_INTERVAL seconds
+FSYNC_INTERVAL = 1.0
+FSYNC_BATCH = 32
+_JOURNALS = weakref.WeakSet()
+
+
+def get_round_suffix(video_path):
+    # videos rendered from round N annotations live under ann_human/N/
+    if '/0/' in video_path:
+        return '_1'
+    elif '/1/' in video_path:
+        return '_2'
+    elif '/2/' in video_path:
+        return '_3'
+    return ''
+
+
+class HistoryJournal:
+    """
+    Append-only line journal shared by all server processes.
+
+    Every record is one line written with a single O_APPEND write under an
+    exclusive portalocker lock, so concurrent saves never lose lines. fsync is
+    batched: it runs every `fsync_batch` records or when `fsync_interval`
+    seconds passed since the last one. A torn last line (crash mid-write) is
+    ignored by readers, cut off by the next `append` and dropped by `compact`.
+    """
+
+    def __init__(self, path, fsync_interval=FSYNC_INTERVAL, fsync_batch=FSYNC_BATCH):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.fsync_batch = fsync_batch
+        self._file = None
+        self._pending = 0
+        self._last_sync = time.time()
+        _JOURNALS.add(self)
+
+    def _open(self):
+        if self._file is not None:
+            try:
+                same_file = os.fstat(self._file.fileno()).st_ino == os.stat(self.path).st_ino
+            except FileNotFoundError:
+                same_file = False
+            if same_file:
+                return self._file
+            self._file.close()
+        self._file = open(self.path, 'ab')
+        return self._file
+
+    def append(self, line):
+        data = (line.strip() + '\n').encode('utf-8')
+        while True:
+            f = self._open()
+            portalocker.lock(f, portalocker.LOCK_EX)
+            try:
+                # compaction may have replaced the file while we waited for the lock
+                if os.fstat(f.fileno()).st_ino != os.stat(self.path).st_ino:
+                    continue
+                self._cut_torn_tail(f)
+                f.write(data)
+                f.flush()
+                self._pending += 1
+                if self._pending >= self.fsync_batch or time.time() - self._last_sync >= self.fsync_interval:
+                    self._sync(f)
+                return
+            finally:
+                portalocker.unlock(f)
+
+    def _cut_torn_tail(self, f, chunk_size=4096):
+        # a writer crashed mid-line: truncate back to the last newline, so the
+        # next record does not get glued onto the partial one
+        size = os.fstat(f.fileno()).st_size
+        with open(self.path, 'rb') as r:
+            end = size
+            while end > 0:
+                start = max(end - chunk_size, 0)
+                r.seek(start)
+                chunk = r.read(end - start)
+                if end == size and chunk.endswith(b'\n'):
+                    return
+                newline = chunk.rfind(b'\n')
+                if newline >= 0:
+                    end = start + newline + 1
+                    break
+                end = start
+        os.ftruncate(f.fileno(), end)
+
+    def _sync(self, f):
+        os.fsync(f.fileno())
+        self._pending = 0
+        self._last_sync = time.time()
+
+    def sync(self):
+        if self._file is not None and self._pending > 0:
+            self._sync(self._file)
+
+    def read(self, offset=0, inode=None):
+        """
+        Read the complete lines after `offset`. Returns (lines, offset, inode, reset),
+        `reset` is True when the file was replaced or truncated and was read from the start.
+        """
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return [], 0, None, inode is not None
+        with f:
+            stat = os.fstat(f.fileno())
+            reset = stat.st_ino != inode or stat.st_size < offset
+            if reset:
+                offset = 0
+            f.seek(offset)
+            data = f.read()
+        end = data.rfind(b'\n') + 1
+        lines = [line.strip() for line in data[:end].decode('utf-8').splitlines() if line.strip()]
+        return lines, offset + end, stat.st_ino, reset
+
+    def compact(self, unique=False):
+        """
+        Rewrite the journal without torn lines and consecutive duplicates
+        (or all duplicates with `unique`), then atomically swap it in.
+        """
+        with open(self.path, 'ab') as f:
+            portalocker.lock(f, portalocker.LOCK_EX)
+            try:
+                lines, _, _, _ = self.read()
+                compacted, seen = [], set()
+                for line in lines:
+                    if (unique and line in seen) or (len(compacted) > 0 and compacted[-1] == line):
+                        continue
+                    compacted.append(line)
+                    seen.add(line)
+                tmp_path = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp_path, 'wb') as tmp:
+                    tmp.write(''.join([line + '\n' for line in compacted]).encode('utf-8'))
+                    tmp.flush()
+                    os.fsync(tmp.fileno())
+                os.replace(tmp_path, self.path)
+            finally:
+                portalocker.unlock(f)
+        return len(lines), len(compacted)
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+
+class UserHistory:
+    """
+    In-memory view of the user_config/<mode>/<user><suffix>.txt journals of one annotator.
+
+    The journals are read once and afterwards only their new tail is applied,
+    so both saves and lookups are O(1) per new line; a file replaced by
+    compaction is read again from the start. The per-round re-annotation
+    candidates are kept as ready sets:
+        usable[N] = round N-1 history - round N history - finished
+    so the counts sent to the client are plain len() calls. With a task store
+    the rounds are mirrored into its user_videos table: fully when loaded, then
+    only the video of each new line.
+    """
+
+    def __init__(self, save_dir, user_name, suffixes, store=None, mode=None):
+        self.save_dir = save_dir
+        self.user_name = user_name
+        self.suffixes = suffixes
+        self.store = store
+        self.mode = mode
+        self.has_rounds = all(suffix in suffixes for suffix in ROUNDS)
+        self.lock = threading.RLock()
+        self.journals = {suffix: HistoryJournal(self.get_path(suffix)) for suffix in suffixes}
+        self._offset = {suffix: 0 for suffix in suffixes}
+        self._inode = {suffix: None for suffix in suffixes}
+        self.lines = {suffix: [] for suffix in suffixes}
+        self.names = {suffix: set() for suffix in suffixes}
+        self.usable = {i: OrderedDict() for i in range(1, len(ROUNDS))}
+        self.open_names = set()
+
+    def get_path(self, suffix):
+        return os.path.join(self.save_dir, f"{self.user_name}{suffix}.txt")
+
+    def refresh(self):
+        """Apply the lines other processes appended since the last call."""
+        with self.lock:
+            rebuild = False
+            for suffix in self.suffixes:
+                lines, offset, inode, reset = self.journals[suffix].read(self._offset[suffix], self._inode[suffix])
+                self._offset[suffix], self._inode[suffix] = offset, inode
+                if reset:
+                    self.lines[suffix], self.names[suffix] = [], set()
+                    rebuild = True
+                for line in lines:
+                    self._apply(suffix, line, update=not reset)
+            if rebuild:
+                self._rebuild()
+        return self
+
+    def _apply(self, suffix, video_path, update=True):
+        if len(self.lines[suffix]) > 0 and self.lines[suffix][-1] == video_path:
+            return
+        name = get_video_name(video_path)
+        self.lines[suffix].append(video_path)
+        self.names[suffix].add(name)
+        if not update:
+            return
+        finished = self.names.get(FINISH, set())
+        if suffix == FINISH:
+            self.open_names.discard(name)
+            for usable in self.usable.values():
+                usable.pop(name, None)
+            return
+        if suffix == '' and name not in finished:
+            self.open_names.add(name)
+        if not self.has_rounds:
+            return
+        i = ROUNDS.index(suffix)
+        if i > 0:
+            self.usable[i].pop(name, None)
+        if i + 1 < len(ROUNDS) and name not in finished and name not in self.names[ROUNDS[i + 1]]:
+            self.usable[i + 1][name] = video_path
+
+    def _rebuild(self):
+        finished = self.names.get(FINISH, set())
+        self.open_names = self.names[''] - finished
+        if not self.has_rounds:
+            return
+        for i in self.usable:
+            previous, current = ROUNDS[i - 1], ROUNDS[i]
+            self.usable[i] = OrderedDict(
+                (get_video_name(line), line) for line in self.lines[previous]
+                if get_video_name(line) not in finished and get_video_name(line) not in self.names[current]
+            )
+
+    def add(self, suffix, video_path):
+        """Record a saved annotation, re-saving the last video does not add a new line."""
+        video_path = video_path.strip()
+        with self.lock:
+            self.refresh()
+            if len(self.lines[suffix]) > 0 and self.lines[suffix][-1] == video_path:
+                return
+            self.journals[suffix].append(video_path)
+            self.refresh()
+            self.sync_store(get_video_name(video_path))
+
+    def _get_usable(self):
+        return self.refresh().usable
+
+    def sync_store(self, video_name=None):
+        """Write the rounds of `video_name`, or of all videos, to the task store."""
+        if self.store is None or not self.has_rounds:
+            return
+        with self.lock:
+            self.store.update_user_videos(self.mode, self.user_name, self._get_usable, video_name)
+
+    def finish(self, video_path):
+        """Mark a video as finished, it drops out of every re-annotation round."""
+        self.add(FINISH, video_path)
+
+    def last(self, suffix=''):
+        lines = self.lines[suffix]
+        return lines[-1] if len(lines) > 0 else None
+
+    def compact(self):
+        with self.lock:
+            for suffix in self.suffixes:
+                if os.path.exists(self.get_path(suffix)):
+                    self.journals[suffix].compact(unique=suffix == FINISH)
+            return self.refresh()
+
+    def sync(self):
+        for journal in self.journals.values():
+            journal.sync()
+
+
+class HistoryIndex:
+    """Process-wide cache of UserHistory objects, one per (mode, user)."""
+
+    def __init__(self, root_dir, store=None):
+        self.root_dir = root_dir
+        self.store = store
+        self._users = {}
+        self._lock = threading.Lock()
+
+    def get(self, mode, user_name):
+        with self._lock:
+            history = self._users.get((mode, user_name))
+            if history is None:
+                save_dir = os.path.join(self.root_dir, 'user_config', mode)
+                history = UserHistory(save_dir, user_name, MODE_SUFFIXES[mode], self.store, mode)
+                # the journals may have changed while no server was running
+                history.sync_store()
+                self._users[(mode, user_name)] = history
+        return history.refresh()
+
+
+@atexit.register
+def sync_journals():
+    for journal in list(_JOURNALS):
+        journal.sync()